@@ -1,11 +1,11 @@
 import FreeCAD
+import Part
+import os
 import ARTools
 if FreeCAD.GuiUp:
     import FreeCADGui
     from pivy import coin
     from PySide import QtCore, QtGui, QtSvg
-    import Part
-    import os
 
 __title__ = "ARFrames"
 __author__ = "Mathias Hauan Arbo"
@@ -286,22 +286,23 @@ uidir = os.path.join(FreeCAD.getUserAppDataDir(),
                      "Mod", __workbenchname__, "UI")
 icondir = os.path.join(uidir, "icons")
 
-ARTools.spawnClassCommand("FrameCommand",
-                          makeFrame,
-                          {"Pixmap": str(os.path.join(icondir, "frame.svg")),
-                           "MenuText": "Make a free frame",
-                           "ToolTip": "Make a freestanding reference frame."})
-
-ARTools.spawnClassCommand("AllPartFramesCommand",
-                          makeAllPartFrames,
-                          {"Pixmap": str(os.path.join(icondir, "allpartframes.svg")),
-                           "MenuText": "All part frames",
-                           "ToolTip": "Make all part frames."})
-ARTools.spawnClassCommand("FeatureFrameCommand",
-                          spawnFeatureFrameCreator,
-                          {"Pixmap": str(os.path.join(icondir, "featureframecreator.svg")),
-                           "MenuText": "Feature frame creator",
-                           "ToolTip": "Create a feature frame on selected primitive."})
+if FreeCAD.GuiUp:
+    ARTools.spawnClassCommand("FrameCommand",
+                              makeFrame,
+                              {"Pixmap": str(os.path.join(icondir, "frame.svg")),
+                               "MenuText": "Make a free frame",
+                               "ToolTip": "Make a freestanding reference frame."})
+
+    ARTools.spawnClassCommand("AllPartFramesCommand",
+                              makeAllPartFrames,
+                              {"Pixmap": str(os.path.join(icondir, "allpartframes.svg")),
+                               "MenuText": "All part frames",
+                               "ToolTip": "Make all part frames."})
+    ARTools.spawnClassCommand("FeatureFrameCommand",
+                              spawnFeatureFrameCreator,
+                              {"Pixmap": str(os.path.join(icondir, "featureframecreator.svg")),
+                               "MenuText": "Feature frame creator",
+                               "ToolTip": "Create a feature frame on selected primitive."})
 
 
 ###################################################################
@@ -2,8 +2,7 @@ import FreeCAD
 import Part
 import json  # For exporting part infos
 import os    # for safer path handling
-import GazeboExport
-import GraspPose
+import math
 if FreeCAD.GuiUp:
     import FreeCADGui
     from PySide import QtGui
@@ -174,6 +173,68 @@ def getLocalPartProps(obj):
     obj.Placement = old_placement
     return partprops
 
+def shapeFingerprint(shape, rtol=1e-6):
+    """Placement independent key of a shape, equal for partner shapes:
+    the number of faces, edges and vertexes and the volume cell of the
+    shape, see volumeCell."""
+    return (len(shape.Faces), len(shape.Edges), len(shape.Vertexes),
+            volumeCell(shape.Volume, rtol))
+
+
+def volumeCell(volume, rtol=1e-6):
+    """Cell of a volume on a logarithmic grid of cells 2*rtol wide, so
+    that volumes within rtol of each other fall into the same or
+    neighbouring cells. None for shapes without volume."""
+    if volume == 0:
+        return None
+    return math.floor(math.log(abs(volume)) / (2 * rtol))
+
+
+def findPartner(shape_index, obj, rtol=1e-6):
+    """Returns the object in shape_index whose shape is a partner of
+    obj's shape. shape_index maps fingerprints to the (object, volume,
+    area) of unique shapes, obj is added to it when no partner is found
+    and None is returned. Only shapes of the same topology and of the
+    same volume and area within rtol are compared with isPartner, they
+    are looked up in the cell of the volume and its neighbours."""
+    shape = obj.Shape
+    volume, area = shape.Volume, shape.Area
+    key = shapeFingerprint(shape, rtol)
+    cells = [key[3]] if key[3] is None else [key[3], key[3] - 1, key[3] + 1]
+    for cell in cells:
+        for uobj, uvolume, uarea in shape_index.get(key[:3] + (cell,), []):
+            if (abs(uvolume - volume) <= rtol * max(abs(uvolume), abs(volume))
+                    and abs(uarea - area) <= rtol * max(abs(uarea), abs(area))
+                    and uobj.Shape.isPartner(shape)):
+                return uobj
+    shape_index.setdefault(key, []).append((obj, volume, area))
+    return None
+
+def manifestUpToDate(manifest_file, manifest):
+    """Checks whether a package's manifest.json records the same inputs
+    as manifest, the package files it lists still exist and its mesh
+    still has the content the package was written with."""
+    import GazeboExport
+    try:
+        with open(manifest_file, "r", encoding="utf8") as manifest_in:
+            saved = json.load(manifest_in)
+    except (OSError, ValueError):
+        return False
+    package_dir = os.path.dirname(manifest_file)
+    mesh = saved.pop("mesh", None)
+    mesh_digest = saved.pop("mesh_digest", None)
+    if mesh is None or saved != json.loads(json.dumps(manifest)):
+        return False
+    files = [os.path.join(package_dir, f)
+             for f in ("model.sdf", "model.config", "frames.json")]
+    if not all(os.path.exists(f) for f in files):
+        return False
+    mesh_file = os.path.join(os.path.dirname(package_dir), mesh)
+    try:
+        return GazeboExport.file_digest(mesh_file) == mesh_digest
+    except OSError:
+        return False
+
 # Longest match for mesh name
 
 def longest_match(seq1, seq2):
@@ -188,8 +249,18 @@ def longest_match(seq1, seq2):
 # Export functions
 ###################################################################
 
-def exportGazeboModels():
-    """Export packages for Gazebo Simulator."""
+def isExportPart(obj):
+    """True for the parts that get a Gazebo package,
+    not grasp poses or grippers."""
+    return (obj.TypeId == "Part::Feature"
+            and not "PartToHandle" in obj.PropertiesList
+            and not "Container" in obj.PropertiesList)
+
+
+def exportGazeboModels(configs={}):
+    """Export packages for Gazebo Simulator of the selected parts to a
+    directory chosen in a dialog, in the background with progress shown
+    in a task panel. See exportGazeboPackages for configs."""
     doc = FreeCAD.activeDocument()
     selected_objects = FreeCADGui.Selection.getSelection()
     FreeCADGui.Selection.clearSelection()
@@ -199,86 +270,240 @@ def exportGazeboModels():
 
     export_dir = QtGui.QFileDialog.getExistingDirectory(None, "Choose Export Directory", 
                                                         os.path.split(doc.FileName)[0])
-    
-    # Gather the unique shapes, and clone parts as
-    # dict = { partX : { obj1: <obj>, graspposes: {}, placements : {}, mesh: <mesh_uri> } }
-    unique_objs = []
-    parts = {}
-    num_objs = 0
-    for obj in doc.Objects:
-        new_shape = True
-        model_dir = os.path.join(export_dir, obj.Label)
-        mesh_dir = os.path.join(model_dir, 'meshes')
-        mesh_file = os.path.join(mesh_dir, obj.Label + '.dae')
-        mesh_uri = os.path.normpath(os.path.relpath(mesh_file, export_dir))
-        # Select only Parts, not Grasp Poses or Gripper
-        if obj.TypeId == "Part::Feature" and not "PartToHandle" in obj.PropertiesList and not "Container" in obj.PropertiesList:
-            num_objs += 1
-            for uobj in unique_objs:
-                if uobj.Shape.isPartner(obj.Shape):
-                    new_shape = False
-                    # parts[obj.Label]["mesh"] += parts[uobj.Label]["mesh"]
-                    parts[obj.Label] = {"obj": obj, 
-                                        "graspposes": {},
-                                        "mesh": parts[uobj.Label]["mesh"]
-                                        }
-            # if Shape is unique export mesh
-            if new_shape:
-                unique_objs.append(obj)
-                parts[obj.Label] = {"obj": obj, "graspposes": {}, "placements": {}, "mesh": mesh_file}
-
-    for obj in doc.Objects:
-        # Add grasp poses to parts dictionary
-        if "PartToHandle" in obj.PropertiesList:
-            graspposes = { obj.Container.Label: {
-                            "placement": placement2pose(obj.Container.Placement),
-                            "distance": obj.GripSize*1e-3
-                            # "OperationType" : obj.OperationType
-                            # "Operation Priority" : obj.OperationPriority
-                            # obj.Operation Parameter 1 : obj.OperationParameter1
-                            # obj.Operation Parameter 2 : obj.OperationParameter2
-                            # obj.Operation Parameter 3 : obj.OperationParameter3
+    if not export_dir:
+        return False
+    # export in worker processes, the task panel shows the progress
+    import ExportTask
+    FreeCADGui.Control.showDialog(
+        ExportTask.GazeboExportPanel(selected_objects, export_dir, configs))
+    return True
+
+
+def exportGazeboPackages(objects, export_dir, configs={}):
+    """Export packages for Gazebo Simulator without the GUI.
+    objects - a document to export all its parts, or a list of parts
+    of one document.
+    configs["shared_meshes"] - "hardlink" or "uri" to write every unique
+    mesh once to a content-addressed store in the export directory and
+    hardlink it into, or refer to it from, the packages.
+    configs["incremental"] - skip packages whose manifest.json shows
+    that their shape, placement, frames and settings are unchanged.
+    configs["mesh_format"] - "dae" (default), "stl" or "glb".
+    configs["mesh_archive"] - also write every mesh as a .qmz archive, a
+    compact quantized and gzipped copy for storage and transfer that
+    GazeboExport.read_qmz decodes, next to the mesh the model loads.
+    configs["collision"] - "decimate" or "hull" for separate collision
+    meshes of at most configs["collision_triangles"] triangles.
+    configs["primitive_collisions"] - use box, cylinder and sphere
+    collisions for parts matching them within configs["primitive_tolerance"].
+    configs["adaptive_quality"] - tessellate with a linear deflection of
+    this fraction of each part's bounding box diagonal, and an angular
+    deflection of configs["angular_deflection"] if set. Combined with
+    configs["triangle_budget"] the deflections are coarsened until the
+    main meshes of the export have at most that many triangles in total,
+    levels of detail and collision meshes come on top.
+    configs["lod_tiers"] - deflection factors of additional coarser meshes,
+    configs["collision"] = "lod" collides with the coarsest of them.
+    configs["workers"] - number of headless FreeCAD worker processes
+    writing the packages in parallel, configs["python"] the interpreter
+    they run on (see ExportPool.worker_python).
+    configs["assembly"] - also write the selection as one model with a
+    link per part, fixed in their document placements, named after the
+    value or, if True, after the parts. configs["assembly_format"] is
+    "sdf" (default) or "urdf".
+    configs["density"] - density of the parts in kg/m^3, 1000 by default,
+    configs["densities"] a { label: density } table overriding it.
+    configs["inertia_backend"] - "mesh" to approximate inertials from the
+    tessellation instead of the exact OCCT integrals.
+    configs["principal_inertia"] - write diagonal inertia tensors in the
+    principal axes of the parts.
+    configs["weld_tolerance"] - weld mesh vertices within this distance
+    in meters and drop degenerate and duplicate triangles.
+    configs["weld_normal_tolerance"] - weld normals within this distance,
+    1e-4 by default.
+    Returns { "packages": { label: <mesh path> }, "skipped": [<label>],
+              "assembly": <model path> or None }."""
+    import GazeboExport
+    selected_objects = exportSelection(objects)
+    configs = fitTriangleBudget(selected_objects, configs)
+    results = {"packages": {}, "skipped": [], "assembly": None}
+
+    # Meshes and mass properties are shared by partners and by the assembly
+    tessellation_cache = GazeboExport.TessellationCache()
+    mass_cache = GazeboExport.MassPropertyCache()
+    assembly = [] if configs.get("assembly") else None
+
+    def assemblyParts(parts):
+        for part in parts:
+            if assembly is not None:
+                assembly.append({"obj": part["obj"], "shape_hash": part["shape_hash"]})
+            yield part
+
+    # Export assets for parts, one at a time through the stages
+    if configs.get("workers"):
+        import ExportPool
+        # the BREPs hashed for dedupe are the ones sent to the workers
+        max_in_flight = 2 * configs["workers"]
+        breps = ExportPool.BrepCache(max_in_flight)
+        parts = assemblyParts(dedupeParts(discoverParts(selected_objects),
+                                          breps.shape_hash))
+        jobs = packageJobs(parts, export_dir, configs, results["skipped"])
+        results["packages"] = dict(ExportPool.export_packages(
+            jobs, configs["workers"], configs.get("python"), max_in_flight, breps))
+    else:
+        parts = assemblyParts(dedupeParts(discoverParts(selected_objects)))
+        jobs = packageJobs(parts, export_dir, configs, results["skipped"])
+        for job in jobs:
+            results["packages"][job["name"]] = GazeboExport.export_package(
+                cache=tessellation_cache, mass_cache=mass_cache, **job)
+
+    # Export asset for subassembly
+    if assembly:
+        results["assembly"] = GazeboExport.export_assembly(
+            assemblyName(selected_objects, configs), assembly, export_dir, configs,
+            tessellation_cache, mass_cache)
+
+    return results
+
+
+###################################################################
+# Export stages
+###################################################################
+# The Gazebo export runs as a chain of generators, discoverParts ->
+# dedupeParts -> packageJobs -> export, each handing on one part at a
+# time, so only the parts in flight are held in memory.
+
+def exportSelection(objects):
+    """The parts to export of a document, or a list of parts, which is
+    used as is so that the document is never traversed for it."""
+    if hasattr(objects, "Objects"):
+        return [obj for obj in objects.Objects if isExportPart(obj)]
+    return list(objects)
+
+
+def fitTriangleBudget(selected_objects, configs):
+    """Coarsens the adaptive tessellation in configs until the main meshes
+    of the export fit configs["triangle_budget"] triangles, see
+    GazeboExport.fit_triangle_budget. The parts are copied and meshed one
+    at a time on the caller's thread."""
+    if not (configs.get("triangle_budget") and configs.get("adaptive_quality")):
+        return configs
+    import GazeboExport
+    shapes = lambda: (GazeboExport.part_shape(obj, local=True)
+                      for obj in selected_objects)
+    return dict(configs, quality_scale=GazeboExport.fit_triangle_budget(
+        shapes, configs, configs["triangle_budget"]))
+
+
+def assemblyName(selected_objects, configs):
+    subasm_name = configs["assembly"]
+    if subasm_name is True:
+        subasm_name = "_".join(list(map(lambda x: x.Label[:8], selected_objects)))
+    return subasm_name
+
+
+def partFeatures(obj, frame_type):
+    """Grasp poses and placements on Plane surfaces of a part. They link
+    to the part, so only its InList is searched, not the document.
+    frame_type - ARFrames.FeatureFrame"""
+    features = {"graspposes": {}, "placements": {}}
+    for feature in obj.InList:
+        # Add grasp poses of the part
+        if "PartToHandle" in feature.PropertiesList and feature.PartToHandle == obj:
+            features["graspposes"] = { feature.Container.Label: {
+                            "placement": placement2pose(feature.Container.Placement),
+                            "distance": feature.GripSize*1e-3
+                            # "OperationType" : feature.OperationType
+                            # "Operation Priority" : feature.OperationPriority
+                            # feature.Operation Parameter 1 : feature.OperationParameter1
+                            # feature.Operation Parameter 2 : feature.OperationParameter2
+                            # feature.Operation Parameter 3 : feature.OperationParameter3
                             }
                         }
-            parts[obj.PartToHandle.Label].update({"graspposes" : graspposes})
 
         # Add part placement position on Plane surface
-        import ARFrames
-        if hasattr(obj, 'Proxy') and "ShapeType" in obj.PropertiesList:
-            if isinstance(obj.Proxy, ARFrames.FeatureFrame) and obj.ShapeType == 'Face':
-                parts[obj.Part.Label].update({ "placements": { obj.Label: placement2pose(obj.Placement) } })
-
-    # Create SDF package from Parts or other packages
-    def create_package(name, objects, export_dir):
-        model_dir = os.path.join(export_dir, name)
-        mesh_dir = os.path.join(model_dir, 'meshes')
-        os.makedirs(mesh_dir, exist_ok=True)
-
-        GazeboExport.export_collada(objects, parts[name]["mesh"])
-        GazeboExport.export_sdf({ name: parts[name] }, export_dir, obj.Label)
-
-        with open(os.path.join(model_dir, 'model.config'), 'w') as config_file:
-            config_file.write(GazeboExport.config(name, 
-                'model.sdf', 'Author', 'Email', 'Comment', 'Version'))
-
-        with open(os.path.join(model_dir, 'frames.json'), 'w') as frames_file:
-            json.dump({"label": name,
-                        "placement": placement2pose(parts[name]["obj"].Placement),
-                        "features": 
-                            { "graspposes" : parts[name]["graspposes"]
-                            , "placements" : parts[name]["placements"]}},
-                        frames_file, indent=1, separators=(',', ': '))
-
-
-    # Export assets for parts
-    for obj in selected_objects:
-        create_package(obj.Label, [obj], export_dir)
+        if hasattr(feature, 'Proxy') and "ShapeType" in feature.PropertiesList:
+            if (isinstance(feature.Proxy, frame_type) and feature.ShapeType == 'Face'
+                    and feature.Part == obj):
+                features["placements"] = { feature.Label: placement2pose(feature.Placement) }
+    return features
 
-    # Export asset for subassembly
-    # subasm_name = "_".join(list(map(lambda x: x.Label[:8], selected_objects)))
-    # create_package(subasm_name, selected_objects, export_dir)
 
-    return True
+def discoverParts(selected_objects):
+    """Yields each part to export as
+    { "obj": <obj>, "graspposes": {}, "placements": {} }."""
+    import ARFrames
+    for obj in selected_objects:
+        part = {"obj": obj}
+        part.update(partFeatures(obj, ARFrames.FeatureFrame))
+        yield part
+
+
+def dedupeParts(parts, hash_shape=None):
+    """Passes on parts with the "shape_hash" of their shape in the part
+    frame, computed once per unique shape. Parts whose shape is a partner
+    of an earlier one get its label as "partner".
+    hash_shape - function (obj) -> shape hash, e.g. of an
+    ExportPool.BrepCache which keeps the BREP it hashed for the workers"""
+    import GazeboExport
+    if hash_shape is None:
+        hash_shape = lambda obj: GazeboExport.shape_hash(
+            GazeboExport.part_shape(obj, local=True))
+    shape_index = {}
+    shape_hashes = {}
+    for part in parts:
+        obj = part["obj"]
+        uobj = findPartner(shape_index, obj)
+        if uobj is not None:
+            part["partner"] = uobj.Label
+        unique = part.get("partner", obj.Label)
+        if unique not in shape_hashes:
+            shape_hashes[unique] = hash_shape(obj)
+        part["shape_hash"] = shape_hashes[unique]
+        yield part
+
+
+def packageJobs(parts, export_dir, configs={}, skipped=None, check_manifests=True):
+    """Passes on the GazeboExport.export_package job of each part. Parts
+    whose package is up to date are appended to skipped instead, unless
+    check_manifests is False, which leaves configs["incremental"] to the
+    worker running the job (see ExportPool.run_job)."""
+    import GazeboExport
+    settings = GazeboExport.package_settings(configs)
+    for part in parts:
+        name = part["obj"].Label
+        unique = part.get("partner", name)
+        # inputs of the package, partners share the hash of their shape
+        manifest = {"shape": part["shape_hash"],
+                    "placement": placement2pose(part["obj"].Placement),
+                    "graspposes": part["graspposes"],
+                    "placements": part["placements"],
+                    "settings": settings}
+        manifest_file = os.path.join(export_dir, name, 'manifest.json')
+        if (check_manifests and configs.get("incremental")
+                and manifestUpToDate(manifest_file, manifest)):
+            FreeCAD.Console.PrintMessage("Package " + name + " is up to date\n")
+            if skipped is not None:
+                skipped.append(name)
+            continue
+
+        # every package writes its own mesh, partners only share the
+        # shape serialized for the workers
+        mesh_file = os.path.join(export_dir, name, 'meshes', name + '.dae')
+        frames = {"label": name,
+                  "placement": placement2pose(part["obj"].Placement),
+                  "features":
+                      { "graspposes" : part["graspposes"]
+                      , "placements" : part["placements"]}}
+        yield {"name": name,
+               "part": {"obj": part["obj"],
+                        "mesh": mesh_file,
+                        "shape_hash": part["shape_hash"],
+                        "partner": unique},
+               "export_dir": export_dir,
+               "frames": frames,
+               "manifest": manifest,
+               "configs": configs}
 
 
 def exportPartInfo(obj, ofile):
@@ -513,6 +738,12 @@ def exportPartInfoAndFeaturesDialogue():
                                  + " exported to " + str(ofile) + "\n")
 
 
+def insertGraspPose():
+    """Inserts a grasp pose for the selected part, see GraspPose.insert."""
+    import GraspPose
+    GraspPose.insert()
+
+
 ###################################################################
 # GUI Commands
 ###################################################################
@@ -520,23 +751,24 @@ uidir = os.path.join(FreeCAD.getUserAppDataDir(),
                      "Mod", __workbenchname__, "UI")
 icondir = os.path.join(uidir, "icons")
 
-spawnClassCommand("ExportPartInfoAndFeaturesDialogueCommand",
-                  exportPartInfoAndFeaturesDialogue,
-                  {"Pixmap": str(os.path.join(icondir, "parttojson.svg")),
-                   "MenuText": "Export info and featureframes",
-                   "ToolTip": "Export part properties (placement, C.O.M) and feature frames"})
-
-spawnClassCommand("ExportGazeboModels",
-                  exportGazeboModels,
-                  {"Pixmap": str(os.path.join(icondir, "gazeboexport.svg")),
-                   "MenuText": "Export SDF-models to Gazebo",
-                   "ToolTip": "Export SDF-models for all solid parts"})
-
-spawnClassCommand("InsertGraspPose",
-                  GraspPose.insert,
-                  {"Pixmap": str(os.path.join(icondir, "addgrasppose.svg")),
-                   "MenuText": "Insert Grasp Pose",
-                   "ToolTip": "Insert Grasp Pose for Selected Part"})
+if FreeCAD.GuiUp:
+    spawnClassCommand("ExportPartInfoAndFeaturesDialogueCommand",
+                      exportPartInfoAndFeaturesDialogue,
+                      {"Pixmap": str(os.path.join(icondir, "parttojson.svg")),
+                       "MenuText": "Export info and featureframes",
+                       "ToolTip": "Export part properties (placement, C.O.M) and feature frames"})
+
+    spawnClassCommand("ExportGazeboModels",
+                      exportGazeboModels,
+                      {"Pixmap": str(os.path.join(icondir, "gazeboexport.svg")),
+                       "MenuText": "Export SDF-models to Gazebo",
+                       "ToolTip": "Export SDF-models for all solid parts"})
+
+    spawnClassCommand("InsertGraspPose",
+                      insertGraspPose,
+                      {"Pixmap": str(os.path.join(icondir, "addgrasppose.svg")),
+                       "MenuText": "Insert Grasp Pose",
+                       "ToolTip": "Insert Grasp Pose for Selected Part"})
 
 
 ###################################################################
@@ -0,0 +1,281 @@
+import FreeCAD
+import os
+import sys
+import glob
+import json
+import time
+import hashlib
+import argparse
+import traceback
+import collections
+import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
+
+# Exports the Gazebo packages, part info and feature frames of many FCStd
+# or STEP files, one file at a time per headless FreeCAD worker process.
+# Finished files are recorded in <output>/batch_state.json, so an
+# interrupted batch resumes where it stopped when run again.
+# Run with: FreeCADCmd BatchExport.py --pass <files or globs> -o <output dir>
+# or with any python that imports FreeCAD: python BatchExport.py ...
+
+INPUT_EXTENSIONS = ('.fcstd', '.step', '.stp')
+STATE_FILE = 'batch_state.json'
+
+
+###################################################################
+# Worker
+###################################################################
+def open_document(path):
+    '''Opens an FCStd document, or imports a STEP file into a new one'''
+    if path.lower().endswith('.fcstd'):
+        return FreeCAD.openDocument(path)
+    import Import
+    doc = FreeCAD.newDocument(os.path.splitext(os.path.basename(path))[0])
+    Import.insert(path, doc.Name)
+    doc.recompute()
+    return doc
+
+
+def export_file(path, target, configs={}):
+    '''Writes the Gazebo packages of a file to target and the part info
+    and feature frames of each part to target/part_info/<label>.json.
+    Returns its job record, failures included'''
+    import ARTools
+    start = time.perf_counter()
+    record = {"status": "done", "error": None}
+    doc = None
+    try:
+        doc = open_document(path)
+        results = ARTools.exportGazeboPackages(doc, target, configs)
+        info_dir = os.path.join(target, 'part_info')
+        for obj in doc.Objects:
+            if ARTools.isExportPart(obj):
+                info_file = os.path.join(info_dir, obj.Label + '.json')
+                ARTools.exportPartInfo(obj, info_file)
+                ARTools.appendFeatureFrames(obj, info_file)
+        record["packages"] = len(results["packages"])
+        record["up_to_date"] = len(results["skipped"])
+    except Exception:
+        record.update(status="failed", error=traceback.format_exc())
+    finally:
+        if doc is not None:
+            FreeCAD.closeDocument(doc.Name)
+    record["seconds"] = time.perf_counter() - start
+    return record
+
+
+###################################################################
+# Pool
+###################################################################
+def failed_record():
+    '''Job record of a file whose worker failed, from the exception
+    being handled'''
+    return {"status": "failed", "error": traceback.format_exc(), "seconds": 0}
+
+
+def export_isolated(job, path, target, configs={}, python=None):
+    '''Runs a job in a worker process of its own, so that a crash of
+    FreeCAD on this file takes down no other file'''
+    import ExportPool
+    with ExportPool.make_pool(1, python) as pool:
+        return pool.submit(job, path, target, configs).result()
+
+
+def export_files(paths, targets, configs={}, workers=None, python=None, job=None):
+    '''Yields (path, record) of export_file for every path as the workers
+    finish them. Only as many files as workers are handed out at a time,
+    so a worker that dies fails only the files in flight with it. The pool
+    is then restarted and those files are exported again once, each in a
+    worker of its own, like ExportService.run does
+    job - worker function (path, target, configs) -> record, export_file
+    by default'''
+    import ExportPool
+    if job is None:
+        # submit the worker through its module, as __main__ it would not
+        # pickle by reference into the spawned workers
+        import BatchExport
+        job = BatchExport.export_file
+    workers = workers or os.cpu_count()
+    pending = collections.deque(paths)
+    in_flight = {}
+    pool = ExportPool.make_pool(workers, python)
+    try:
+        while pending or in_flight:
+            while pending and len(in_flight) < workers:
+                path = pending.popleft()
+                future = pool.submit(job, path, targets[path], configs)
+                in_flight[future] = path
+            done, _ = concurrent.futures.wait(
+                in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+            if any(isinstance(future.exception(), BrokenProcessPool) for future in done):
+                # every job of the broken pool fails, wait for all of them
+                done, _ = concurrent.futures.wait(in_flight)
+            broken = []
+            for future in done:
+                path = in_flight.pop(future)
+                try:
+                    record = future.result()
+                except BrokenProcessPool:
+                    broken.append(path)
+                    continue
+                except Exception:
+                    record = failed_record()
+                yield path, record
+            if not broken:
+                continue
+            print("A worker died, restarting the pool and retrying %d files"
+                  % len(broken))
+            pool.shutdown(wait=False)
+            pool = ExportPool.make_pool(workers, python)
+            with concurrent.futures.ThreadPoolExecutor(len(broken)) as threads:
+                retries = {threads.submit(export_isolated, job, path, targets[path],
+                                          configs, python): path
+                           for path in broken}
+                for future in concurrent.futures.as_completed(retries):
+                    try:
+                        yield retries[future], future.result()
+                    except Exception:
+                        yield retries[future], failed_record()
+    finally:
+        pool.shutdown(wait=False)
+
+
+###################################################################
+# Job state
+###################################################################
+def file_stamp(path):
+    '''Modification time and size, a rerun exports changed files again'''
+    stat = os.stat(path)
+    return {"mtime": stat.st_mtime, "size": stat.st_size}
+
+
+def load_state(output, configs):
+    '''Job state of a previous batch into output with the same configs'''
+    try:
+        with open(os.path.join(output, STATE_FILE)) as state_file:
+            state = json.load(state_file)
+    except (OSError, ValueError):
+        state = None
+    if not state or state.get("configs") != configs:
+        state = {"configs": configs, "files": {}}
+    return state
+
+
+def save_state(output, state):
+    path = os.path.join(output, STATE_FILE)
+    tmp = '%s.tmp%d' % (path, os.getpid())
+    with open(tmp, 'w') as state_file:
+        json.dump(state, state_file, indent=1, separators=(',', ': '))
+    os.replace(tmp, path)
+
+
+def is_done(state, path):
+    record = state["files"].get(path)
+    if record is None or record["status"] != "done":
+        return False
+    stamp = file_stamp(path)
+    return record["mtime"] == stamp["mtime"] and record["size"] == stamp["size"]
+
+
+###################################################################
+# Batch
+###################################################################
+def expand_inputs(patterns):
+    '''Absolute paths of the FCStd and STEP files matching files or
+    glob patterns, in order and without duplicates'''
+    paths = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern, recursive=True)) or [pattern]
+        for match in matches:
+            path = os.path.abspath(match)
+            if (os.path.isfile(path) and path.lower().endswith(INPUT_EXTENSIONS)
+                    and path not in paths):
+                paths.append(path)
+    return paths
+
+
+def target_dirs(paths, output):
+    '''Output directory of each file, named after it and made unique by
+    a hash of its path where names clash'''
+    targets = {}
+    used = set()
+    for path in paths:
+        name = os.path.splitext(os.path.basename(path))[0]
+        if name in used:
+            name += '_' + hashlib.sha1(path.encode()).hexdigest()[:8]
+        used.add(name)
+        targets[path] = os.path.join(output, name)
+    return targets
+
+
+def print_summary(state, paths, resumed, wall_time):
+    records = [state["files"][path] for path in paths if path in state["files"]]
+    done = [r for r in records if r["status"] == "done"]
+    failed = [path for path in paths
+              if state["files"].get(path, {}).get("status") == "failed"]
+    print("")
+    print("files:     %d" % len(paths))
+    print("exported:  %d" % (len(done) - resumed))
+    print("resumed:   %d (done in an earlier run)" % resumed)
+    print("failed:    %d" % len(failed))
+    print("packages:  %d" % sum(r.get("packages", 0) for r in done))
+    print("cpu time:  %.1f s" % sum(r["seconds"] for r in records))
+    print("wall time: %.1f s" % wall_time)
+    slowest = sorted(paths, key=lambda p: -state["files"].get(p, {}).get("seconds", 0))
+    for path in slowest[:5]:
+        if path in state["files"]:
+            print("  %8.1f s  %s" % (state["files"][path]["seconds"], path))
+    for path in failed:
+        print("FAILED %s\n%s" % (path, state["files"][path]["error"]))
+
+
+def script_arguments(argv):
+    '''Arguments meant for the script: FreeCADCmd hands them over after
+    --pass, a plain python after the script name'''
+    for separator in ('--pass', '--'):
+        if separator in argv:
+            return argv[argv.index(separator) + 1:]
+    return argv[1:]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Export Gazebo packages, part info and feature frames "
+                    "of FCStd/STEP files in parallel")
+    parser.add_argument('inputs', nargs='+', help="files or glob patterns")
+    parser.add_argument('-o', '--output', required=True, help="output directory")
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help="worker processes, one per CPU by default")
+    parser.add_argument('--python', default=None,
+                        help="interpreter of the workers, see ExportPool.worker_python")
+    parser.add_argument('--configs', default='{}',
+                        help="json object of ARTools.exportGazeboPackages configs")
+    parser.add_argument('--restart', action='store_true',
+                        help="export every file again, ignoring the saved job state")
+    args = parser.parse_args(script_arguments(sys.argv) if argv is None else argv)
+
+    configs = json.loads(args.configs)
+    output = os.path.abspath(args.output)
+    os.makedirs(output, exist_ok=True)
+    paths = expand_inputs(args.inputs)
+    targets = target_dirs(paths, output)
+    state = load_state(output, configs)
+    if args.restart:
+        state["files"] = {}
+    pending = [path for path in paths if not is_done(state, path)]
+    resumed = len(paths) - len(pending)
+    print("%d files, %d to export, %d done earlier" % (len(paths), len(pending), resumed))
+
+    start = time.perf_counter()
+    for path, record in export_files(pending, targets, configs, args.workers, args.python):
+        record.update(file_stamp(path))
+        state["files"][path] = record
+        save_state(output, state)
+        print("%-6s %8.1f s  %s" % (record["status"], record["seconds"], path))
+    print_summary(state, paths, resumed, time.perf_counter() - start)
+    return all(state["files"][path]["status"] == "done" for path in paths)
+
+
+if __name__ == "__main__":
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    sys.exit(0 if main() else 1)
@@ -0,0 +1,228 @@
+import FreeCAD
+import Part
+import os
+import sys
+import shutil
+import collections
+import multiprocessing
+import concurrent.futures
+import GazeboExport
+
+# Runs Gazebo package exports in a pool of headless FreeCAD worker processes.
+# Shapes are handed to the workers as BREP, so jobs carry no document objects.
+
+
+###################################################################
+# Pool
+###################################################################
+def worker_python():
+    '''Returns the python interpreter for the workers. Inside FreeCAD
+    sys.executable is FreeCAD itself, so the interpreter bundled with
+    FreeCAD is preferred, then the python3 on the PATH.'''
+    if os.path.basename(sys.executable).lower().startswith("python"):
+        return sys.executable
+    bindir = os.path.join(FreeCAD.getHomePath(), "bin")
+    for name in ("python3", "python", "python.exe"):
+        candidate = os.path.join(bindir, name)
+        if os.path.isfile(candidate):
+            return candidate
+    return shutil.which("python3") or shutil.which("python")
+
+
+def make_pool(workers=None, python=None):
+    '''Creates a process pool of headless FreeCAD workers. The workers
+    are spawned with the sys.path of this process, which makes FreeCAD
+    and the workbench modules importable in them.'''
+    context = multiprocessing.get_context("spawn")
+    context.set_executable(python or worker_python())
+    return concurrent.futures.ProcessPoolExecutor(workers, mp_context=context)
+
+
+###################################################################
+# Jobs
+###################################################################
+class BrepCache(object):
+    '''BREPs of shapes in their part frames, by the label of the part
+    that owns a unique shape, the latest max_size of them if given.
+    Serializing is the only work on the shapes left to the caller's
+    thread, hashes are taken of the BREP text.'''
+    def __init__(self, max_size=None):
+        self.breps = collections.OrderedDict()
+        self.max_size = max_size
+
+    def get(self, obj, unique=None):
+        unique = unique or obj.Label
+        if unique in self.breps:
+            self.breps.move_to_end(unique)
+            return self.breps[unique]
+        brep = GazeboExport.part_shape(obj, local=True).exportBrepToString()
+        self.breps[unique] = brep
+        if self.max_size:
+            while len(self.breps) > self.max_size:
+                self.breps.popitem(last=False)
+        return brep
+
+    def shape_hash(self, obj):
+        '''GazeboExport.shape_hash of obj in its part frame'''
+        return GazeboExport.brep_digest(self.get(obj))
+
+
+def serialize_job(job, breps):
+    '''Replaces the document object of a GazeboExport.export_package job
+    by the BREP of its shape in the part frame and its placement.
+    breps - BrepCache of the unique shapes by partner label'''
+    part = job["part"]
+    obj = part["obj"]
+    unique = part.get("partner", job["name"])
+    payload = dict(job)
+    payload["part"] = {"brep": breps.get(obj, unique),
+                       "placement": tuple(obj.Placement.toMatrix().A),
+                       "mesh": part["mesh"],
+                       "shape_hash": part.get("shape_hash")}
+    return payload
+
+
+def assembly_entries(parts, breps=None):
+    '''Yields the parts of a GazeboExport.export_assembly call serialized
+    like serialize_job, one at a time, each unique shape exported once'''
+    breps = breps or BrepCache()
+    for part in parts:
+        obj = part["obj"]
+        yield {"label": obj.Label,
+               "brep": breps.get(obj, part["shape_hash"]),
+               "placement": tuple(obj.Placement.toMatrix().A),
+               "shape_hash": part["shape_hash"]}
+
+
+_document = None
+_caches = None
+
+
+def part_object(part, label):
+    '''Rebuilds a serialized part as a feature of the scratch document'''
+    global _document
+    if _document is None:
+        _document = FreeCAD.newDocument("ARBenchWorker")
+    shape = Part.Shape()
+    shape.importBrepFromString(part["brep"])
+    shape.Placement = FreeCAD.Placement(FreeCAD.Matrix(*part["placement"]))
+    obj = _document.addObject("Part::Feature", "Part")
+    obj.Shape = shape
+    obj.Label = label
+    return obj
+
+
+def worker_caches():
+    '''The (TessellationCache, MassPropertyCache) of this worker process,
+    kept across its jobs, so that the disk cache is indexed once'''
+    global _caches
+    if _caches is None:
+        _caches = (GazeboExport.TessellationCache(), GazeboExport.MassPropertyCache())
+    return _caches
+
+
+def report(queue, name, stage):
+    '''Puts the stage of a job on a progress queue. Its listener may be
+    gone, e.g. after a cancelled export, which must not fail the job.'''
+    try:
+        queue.put((name, stage))
+    except Exception:
+        pass
+
+
+def run_job(payload):
+    '''Worker side of a serialized job: rebuilds the part in a scratch
+    document and writes its package. Returns (name, mesh path), or
+    (name, None) if "check_manifest" is set in the payload and the
+    package is up to date.
+    A "progress" queue in the payload receives (name, stage) as the
+    stages of GazeboExport.export_package start.'''
+    import ARTools
+    payload = dict(payload)
+    if payload.pop("check_manifest", False):
+        manifest_file = os.path.join(payload["export_dir"], payload["name"],
+                                     'manifest.json')
+        if ARTools.manifestUpToDate(manifest_file, payload["manifest"]):
+            return payload["name"], None
+    queue = payload.pop("progress", None)
+    progress = None
+    if queue is not None:
+        progress = lambda stage: report(queue, payload["name"], stage)
+    part = payload["part"]
+    obj = part_object(part, payload["name"])
+    try:
+        job = dict(payload)
+        job["part"] = {"obj": obj,
+                       "mesh": part["mesh"],
+                       "shape_hash": part["shape_hash"]}
+        cache, mass_cache = worker_caches()
+        mesh_file = GazeboExport.export_package(
+            cache=cache, mass_cache=mass_cache, progress=progress, **job)
+    finally:
+        _document.removeObject(obj.Name)
+    return payload["name"], mesh_file
+
+
+def run_assembly(payload):
+    '''Worker side of an assembly: writes the assembly package of
+    { "name": <name>, "parts": [<assembly_entries item>],
+      "export_dir": <path>, "configs": <configs> }.
+    Returns (name, model path).'''
+    objs = [part_object(part, part["label"]) for part in payload["parts"]]
+    try:
+        parts = [{"obj": obj, "shape_hash": part["shape_hash"]}
+                 for obj, part in zip(objs, payload["parts"])]
+        model_file = GazeboExport.export_assembly(
+            payload["name"], parts, payload["export_dir"], payload["configs"],
+            *worker_caches())
+    finally:
+        for obj in objs:
+            _document.removeObject(obj.Name)
+    return payload["name"], model_file
+
+
+def run_count(payload):
+    '''Worker side of a counting pass of the triangle budget: returns the
+    GazeboExport.triangle_count of the shape of payload["brep"] with
+    payload["configs"], see GazeboExport.fit_triangle_budget'''
+    shape = Part.Shape()
+    shape.importBrepFromString(payload["brep"])
+    return GazeboExport.triangle_count(shape, payload["configs"])
+
+
+def export_packages(jobs, workers=None, python=None, max_in_flight=None, breps=None):
+    '''Writes the packages of GazeboExport.export_package jobs in a pool
+    of worker processes. Results are returned, and reported, in job
+    order whatever order the workers finish in.
+    jobs may be a generator, it is consumed as the workers take jobs, at
+    most max_in_flight at a time (twice the workers by default), so only
+    the jobs in flight and their BREPs are held in memory.
+    breps - BrepCache shared with the stage hashing the shapes'''
+    workers = workers or os.cpu_count()
+    max_in_flight = max_in_flight or 2 * workers
+    results = []
+    if breps is None:
+        breps = BrepCache(max_in_flight)
+    in_flight = collections.deque()
+
+    def collect():
+        name, mesh_file = in_flight.popleft().result()
+        FreeCAD.Console.PrintMessage("Exported package " + name + "\n")
+        results.append((name, mesh_file))
+
+    with make_pool(workers, python) as pool:
+        for job in jobs:
+            if len(in_flight) >= max_in_flight:
+                collect()
+            in_flight.append(pool.submit(run_job, serialize_job(job, breps)))
+        while in_flight:
+            collect()
+    return results
+
+
+def warm_up():
+    '''Loads FreeCAD and the exporters into a worker ahead of its first
+    job. Returns the pid of the worker.'''
+    import ARTools
+    import GazeboExport
+    return os.getpid()
@@ -0,0 +1,297 @@
+import os
+import sys
+import json
+import asyncio
+import argparse
+import itertools
+import concurrent.futures
+
+# Long running local export service. It keeps a pool of warm headless
+# FreeCAD workers and takes STEP/FCStd export jobs over a Unix socket or
+# a localhost TCP port, one json request per line:
+#   {"op": "export", "id": <any>, "path": <file>, "output": <dir>, "configs": {}}
+#   {"op": "status"}
+# For every job it streams back json events, one per line: "queued" with
+# its position in the queue, "started", then "done" or "failed" with the
+# BatchExport.export_file record of the job.
+# Run with: python ExportService.py serve --socket /tmp/arbench.sock
+#      and: python ExportService.py submit --socket /tmp/arbench.sock <files> -o <dir>
+
+
+###################################################################
+# Server
+###################################################################
+class ExportService(object):
+    '''Queues export jobs for a pool of warm worker processes. The queue
+    holds at most queue_size jobs; beyond that a client's requests wait,
+    its connection is no longer read and the socket pushes back on it.
+    job - worker function (path, output, configs) -> record,
+    BatchExport.export_file by default
+    make_pool - function (workers) -> executor replacing the warmed
+    ExportPool workers, e.g. for tests without FreeCAD'''
+    def __init__(self, workers=None, python=None, queue_size=64, job=None,
+                 make_pool=None):
+        self.workers = workers or os.cpu_count()
+        self.python = python
+        self.queue_size = queue_size
+        self.job = job
+        self.make_pool = make_pool
+        self.ids = itertools.count()
+        self.running = 0
+        self.finished = 0
+        self.restarts = 0
+        self.pool = None
+
+    async def start(self):
+        '''Starts the workers, each loads FreeCAD before the first job'''
+        if self.job is None:
+            import BatchExport
+            self.job = BatchExport.export_file
+        self.queue = asyncio.Queue(self.queue_size)
+        self.pool_lock = asyncio.Lock()
+        self.pool = await self.new_pool()
+        self.dispatchers = [asyncio.ensure_future(self.dispatch())
+                            for i in range(self.workers)]
+
+    async def new_pool(self, workers=None):
+        workers = workers or self.workers
+        if self.make_pool is not None:
+            return self.make_pool(workers)
+        import ExportPool
+        loop = asyncio.get_event_loop()
+        pool = ExportPool.make_pool(workers, self.python)
+        await asyncio.gather(*[loop.run_in_executor(pool, ExportPool.warm_up)
+                               for i in range(workers)])
+        return pool
+
+    async def restart_pool(self, broken):
+        '''Replaces a pool broken by a dead worker process, once however
+        many of its jobs failed with it'''
+        async with self.pool_lock:
+            if self.pool is broken:
+                broken.shutdown(wait=False)
+                self.pool = await self.new_pool()
+                self.restarts += 1
+
+    def stop(self):
+        for dispatcher in self.dispatchers:
+            dispatcher.cancel()
+        self.pool.shutdown(wait=False)
+
+    async def run(self, request):
+        '''Runs a job on the pool. A job whose pool broke is retried once
+        in a worker of its own: it may have failed with a crash of another
+        job, and if it crashed itself the retry takes down no other job'''
+        loop = asyncio.get_event_loop()
+        args = (self.job, request["path"], request["output"],
+                request.get("configs", {}))
+        pool = self.pool
+        try:
+            return await loop.run_in_executor(pool, *args)
+        except concurrent.futures.process.BrokenProcessPool:
+            # a worker process died, every job of its pool fails
+            await self.restart_pool(pool)
+        except Exception as e:
+            return {"status": "failed", "error": repr(e)}
+        pool = await self.new_pool(1)
+        try:
+            return await loop.run_in_executor(pool, *args)
+        except Exception as e:
+            return {"status": "failed", "error": repr(e)}
+        finally:
+            pool.shutdown(wait=False)
+
+    async def dispatch(self):
+        '''Runs queued jobs on the pool, one at a time per worker. Events
+        are queued on their connections, a client that does not read
+        never holds up a worker'''
+        while True:
+            request, send, finished = await self.queue.get()
+            self.running += 1
+            send({"id": request["id"], "event": "started"})
+            record = await self.run(request)
+            self.running -= 1
+            self.finished += 1
+            send(dict(record, id=request["id"], event=record["status"]))
+            finished.set_result(record)
+            self.queue.task_done()
+
+    def status(self):
+        return {"event": "status", "workers": self.workers,
+                "queued": self.queue.qsize(), "running": self.running,
+                "finished": self.finished, "restarts": self.restarts}
+
+    async def handle(self, reader, writer):
+        '''Serves one client connection. Its events keep streaming after
+        the client is done sending, until all of its jobs have finished'''
+        events = asyncio.Queue()
+        pending = []
+
+        def send(event):
+            events.put_nowait(event)
+
+        async def write_events():
+            connected = True
+            while True:
+                event = await events.get()
+                if event is None:
+                    break
+                if not connected:
+                    continue
+                try:
+                    writer.write((json.dumps(event) + '\n').encode())
+                    await writer.drain()
+                except ConnectionError:
+                    # the client left, its jobs still run
+                    connected = False
+
+        events_writer = asyncio.ensure_future(write_events())
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            try:
+                request = json.loads(line)
+            except ValueError:
+                send({"event": "error", "error": "invalid json"})
+                continue
+            op = request.get("op", "export")
+            if op == "status":
+                send(self.status())
+            elif op == "export" and request.get("path") and request.get("output"):
+                request.setdefault("id", next(self.ids))
+                send({"id": request["id"], "event": "queued",
+                      "position": self.queue.qsize() + 1})
+                finished = asyncio.get_event_loop().create_future()
+                pending.append(finished)
+                await self.queue.put((request, send, finished))
+            else:
+                send({"event": "error", "error": "bad request", "request": request})
+        await asyncio.gather(*pending)
+        send(None)
+        await events_writer
+        writer.close()
+
+    async def serve(self, socket_path=None, host='127.0.0.1', port=0):
+        '''Starts the workers and listens on a Unix socket if given, on
+        host:port otherwise. Returns the asyncio server'''
+        await self.start()
+        if socket_path:
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+            return await asyncio.start_unix_server(self.handle, socket_path)
+        return await asyncio.start_server(self.handle, host, port)
+
+
+###################################################################
+# Client
+###################################################################
+async def connect(socket_path=None, host='127.0.0.1', port=None):
+    if socket_path:
+        return await asyncio.open_unix_connection(socket_path)
+    return await asyncio.open_connection(host, port)
+
+
+async def submit(paths, output, configs={}, socket_path=None, host='127.0.0.1',
+                 port=None):
+    '''Sends an export job per file to a running service and yields its
+    events until every job has finished'''
+    reader, writer = await connect(socket_path, host, port)
+
+    # send while reading events, a full queue stops the service reading
+    # requests until events have been read
+    async def send_requests():
+        for index, path in enumerate(paths):
+            request = {"op": "export", "id": index, "path": os.path.abspath(path),
+                       "output": os.path.abspath(output), "configs": configs}
+            writer.write((json.dumps(request) + '\n').encode())
+            await writer.drain()
+        writer.write_eof()
+
+    sender = asyncio.ensure_future(send_requests())
+    remaining = len(paths)
+    while remaining:
+        line = await reader.readline()
+        if not line:
+            break
+        event = json.loads(line)
+        if event["event"] in ("done", "failed", "error"):
+            remaining -= 1
+        yield event
+    await sender
+    writer.close()
+
+
+async def query_status(socket_path=None, host='127.0.0.1', port=None):
+    reader, writer = await connect(socket_path, host, port)
+    writer.write(b'{"op": "status"}\n')
+    await writer.drain()
+    status = json.loads(await reader.readline())
+    writer.close()
+    return status
+
+
+###################################################################
+# Command line
+###################################################################
+async def run_server(args):
+    service = ExportService(args.workers, args.python, args.queue_size)
+    server = await service.serve(args.socket, args.host, args.port)
+    address = args.socket or "%s:%d" % server.sockets[0].getsockname()[:2]
+    print("export service listening on %s with %d workers" % (address, service.workers))
+    try:
+        await server.serve_forever()
+    finally:
+        service.stop()
+
+
+async def run_client(args):
+    ok = True
+    async for event in submit(args.inputs, args.output, json.loads(args.configs),
+                              args.socket, args.host, args.port):
+        if event["event"] in ("done", "failed"):
+            ok = ok and event["event"] == "done"
+            print("%-6s %8.1f s  %s" % (event["event"], event.get("seconds", 0),
+                                        args.inputs[event["id"]]))
+            if event.get("error"):
+                print(event["error"])
+        elif event["event"] == "error":
+            ok = False
+            print(event)
+    return ok
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Local Gazebo export service")
+    commands = parser.add_subparsers(dest="command")
+    serve = commands.add_parser("serve", help="run the service")
+    serve.add_argument('-j', '--workers', type=int, default=None)
+    serve.add_argument('--python', default=None,
+                       help="interpreter of the workers, see ExportPool.worker_python")
+    serve.add_argument('--queue-size', type=int, default=64)
+    client = commands.add_parser("submit", help="export files with a running service")
+    client.add_argument('inputs', nargs='+', help="FCStd/STEP files")
+    client.add_argument('-o', '--output', required=True, help="output directory")
+    client.add_argument('--configs', default='{}',
+                        help="json object of ARTools.exportGazeboPackages configs")
+    status = commands.add_parser("status", help="show the queue of a running service")
+    for command in (serve, client, status):
+        command.add_argument('--socket', default=None, help="unix socket path")
+        command.add_argument('--host', default='127.0.0.1')
+        command.add_argument('--port', type=int, default=8765)
+    args = parser.parse_args(argv)
+
+    if args.command == "serve":
+        asyncio.run(run_server(args))
+    elif args.command == "submit":
+        return asyncio.run(run_client(args))
+    elif args.command == "status":
+        print(asyncio.run(query_status(args.socket, args.host, args.port)))
+    else:
+        parser.print_help()
+    return True
+
+
+if __name__ == "__main__":
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    sys.exit(0 if main() else 1)
@@ -0,0 +1,405 @@
+import FreeCAD
+import os
+import time
+import queue
+import collections
+import multiprocessing
+from concurrent.futures.process import BrokenProcessPool
+import ARTools
+if FreeCAD.GuiUp:
+    import FreeCADGui
+    from PySide import QtCore, QtGui
+
+
+# Gazebo export in worker processes behind a task panel, which shows the
+# progress of every part and cancels the export. The GUI thread only
+# reads placements and serializes shapes to BREP, a slice of at most
+# SLICE seconds per timer tick, so FreeCAD stays responsive. Meshing,
+# hashing the meshes of up to date packages and fitting the triangle
+# budget all run in the workers. A part deleted or changed during the
+# export fails on its own, and a pool broken by a dead worker is
+# replaced, its jobs retried once.
+
+uidir = os.path.join(FreeCAD.getUserAppDataDir(),
+                     "Mod", ARTools.__workbenchname__, "UI")
+
+SLICE = 0.05
+
+STAGES = {"queued": "Queued",
+          "waiting": "Waiting",
+          "mesh": "Meshing",
+          "lod": "Levels of detail",
+          "collision": "Collision",
+          "model": "Writing model",
+          "done": "Done",
+          "up_to_date": "Up to date",
+          "failed": "Failed",
+          "cancelled": "Cancelled"}
+
+
+###################################################################
+# GUI buttons
+###################################################################
+class GazeboExportPanel(object):
+    """Runs ARTools.exportGazeboPackages for a list of parts in a pool of
+    worker processes, feeding and polling them from a timer on the GUI
+    thread."""
+    def __init__(self, objects, export_dir, configs={}):
+        import ExportPool
+        self.export_dir = export_dir
+        self.configs = configs
+        self.form = FreeCADGui.PySideUic.loadUi(os.path.join(uidir, "ExportProgress.ui"))
+        self.pool = ExportPool.make_pool(configs.get("workers"), configs.get("python"))
+        self.restarts = 0
+        self.manager = multiprocessing.get_context("spawn").Manager()
+        self.progress = self.manager.Queue()
+        # jobs are serialized as workers take them, so only the BREPs of
+        # the jobs in flight are held in memory
+        self.max_in_flight = 2 * (configs.get("workers") or os.cpu_count())
+        self.breps = ExportPool.BrepCache(self.max_in_flight)
+
+        self.objects = ARTools.exportSelection(objects)
+        # the document as the export started, the parts changed or
+        # deleted since fail instead of mixing old and new state
+        self.labels = {}
+        self.states = {}
+        for obj in self.objects:
+            self.labels[id(obj)] = obj.Label
+            self.states[id(obj)] = self.partState(obj)
+        self.assembly_name = None
+        if configs.get("assembly"):
+            self.assembly_name = ARTools.assemblyName(self.objects, configs)
+        self.items = {}
+        for name in [obj.Label for obj in self.objects] + [self.assembly_name]:
+            if name is not None:
+                item = QtGui.QTreeWidgetItem([name, STAGES["waiting"]])
+                self.form.PartsTree.addTopLevelItem(item)
+                self.items[name] = item
+        self.total = len(self.items)
+        self.finished_count = 0
+        self.failed = 0
+        self.skipped = 0
+        self.in_flight = {}
+        # (function, payload, pool, retried) of the futures in flight
+        self.payloads = {}
+        self.isolated = {}
+        self.jobs = None
+        self.current = None
+        self.assembly = None
+        self.assembly_entries = None
+        self.finished = False
+        self.form.ProgressBar.setMaximum(max(self.total, 1))
+
+        # the triangle budget is fitted before any job starts, in passes
+        # counting the triangles of every part in the workers
+        self.budget_pass = None
+        self.budget_parts = None
+        self.budget_futures = {}
+        if configs.get("triangle_budget") and configs.get("adaptive_quality"):
+            self.budget_pass = 0
+            self.budget_scale = configs.get("quality_scale", 1)
+            self.startBudgetPass()
+        else:
+            self.startJobs(configs)
+
+        self.timer = QtCore.QTimer()
+        self.timer.timeout.connect(self.poll)
+        self.timer.start(100)
+
+    def partState(self, obj):
+        return (tuple(obj.Placement.toMatrix().A), obj.Shape.hashCode())
+
+    def checkUnchanged(self, obj):
+        """Raises if a part was deleted or changed since the export started"""
+        label = self.labels[id(obj)]
+        try:
+            state = self.partState(obj)
+        except Exception:
+            raise Exception("%s was deleted during the export" % label)
+        if state != self.states[id(obj)]:
+            raise Exception("%s was changed during the export" % label)
+
+    def startBudgetPass(self):
+        self.budget_pass += 1
+        self.budget_parts = iter(self.objects)
+        self.budget_total = 0
+        self.form.StatusLabel.setText("Fitting the triangle budget, pass %d"
+                                      % self.budget_pass)
+
+    def fitBudget(self):
+        """Starts the next counting pass of the triangle budget, or the
+        jobs once the last pass is counted, like
+        GazeboExport.fit_triangle_budget"""
+        import GazeboExport
+        budget = self.configs["triangle_budget"]
+        if (self.budget_total > budget
+                and self.budget_pass < GazeboExport.BUDGET_PASSES):
+            self.budget_scale = GazeboExport.next_quality_scale(
+                self.budget_total, budget, self.budget_scale)
+            self.startBudgetPass()
+            return
+        if self.budget_total > budget:
+            GazeboExport.warn_over_budget(self.budget_total, budget)
+        self.budget_pass = None
+        self.startJobs(dict(self.configs, quality_scale=self.budget_scale))
+
+    def startJobs(self, configs):
+        """Starts the stages of ARTools.exportGazeboPackages, consumed
+        by poll"""
+        self.configs = configs
+        if configs.get("assembly"):
+            self.assembly = []
+        self.pending = collections.deque(self.objects)
+        self.makeJobs()
+        self.form.StatusLabel.setText("Exporting %d packages" % len(self.objects))
+
+    def makeJobs(self):
+        """Chains the stages over the parts still pending. A part that
+        fails in a stage ends the chain, which is made again for the rest."""
+        parts = ARTools.dedupeParts(ARTools.discoverParts(self.pendingParts()),
+                                    self.breps.shape_hash)
+        self.jobs = ARTools.packageJobs(self.assemblyParts(parts), self.export_dir,
+                                        self.configs, check_manifests=False)
+
+    def pendingParts(self):
+        while self.pending:
+            self.current = self.pending.popleft()
+            self.checkUnchanged(self.current)
+            yield self.current
+
+    def assemblyParts(self, parts):
+        for part in parts:
+            if self.assembly is not None:
+                self.assembly.append({"obj": part["obj"],
+                                      "shape_hash": part["shape_hash"]})
+            yield part
+
+    def checkedAssembly(self):
+        for part in self.assembly:
+            self.checkUnchanged(part["obj"])
+            yield part
+
+    def setStage(self, name, stage):
+        self.items[name].setText(1, STAGES.get(stage, stage))
+
+    def partFailed(self, name, error):
+        self.finished_count += 1
+        self.failed += 1
+        self.setStage(name, "failed")
+        self.items[name].setToolTip(1, str(error))
+        FreeCAD.Console.PrintError("Export of %s failed: %s\n" % (name, error))
+
+    def sliced(self, iterator, deadline, full=lambda: False):
+        """Items of an iterator until the time slice of a tick is used up
+        or full() is true. Sets self.drained once the iterator ran out."""
+        self.drained = False
+        while time.monotonic() < deadline and not full():
+            try:
+                yield next(iterator)
+            except StopIteration:
+                self.drained = True
+                return
+
+    def poolFull(self):
+        return len(self.in_flight) + len(self.budget_futures) >= self.max_in_flight
+
+    def restartPool(self, broken):
+        """Replaces a pool broken by a dead worker process, once however
+        many of its jobs failed with it, like ExportService.restart_pool"""
+        import ExportPool
+        if self.pool is broken:
+            broken.shutdown(wait=False)
+            self.pool = ExportPool.make_pool(self.configs.get("workers"),
+                                             self.configs.get("python"))
+            self.restarts += 1
+
+    def submit(self, name, fn, payload, futures):
+        """Submits a job, to a new pool if a dead worker broke the pool"""
+        pool = self.pool
+        try:
+            future = pool.submit(fn, payload)
+        except BrokenProcessPool:
+            self.restartPool(pool)
+            pool = self.pool
+            future = pool.submit(fn, payload)
+        futures[future] = name
+        self.payloads[future] = (fn, payload, pool, False)
+
+    def retried(self, future, futures):
+        """Retries a job whose pool broke once in a worker of its own, like
+        ExportService.run: it may have failed with a crash of another job,
+        and if it crashed itself the retry takes down no other job.
+        Returns whether the future was retried."""
+        import ExportPool
+        fn, payload, pool, retried = self.payloads.pop(future)
+        isolated = self.isolated.pop(future, None)
+        if isolated is not None:
+            isolated.shutdown(wait=False)
+        if (retried or future.cancelled()
+                or not isinstance(future.exception(), BrokenProcessPool)):
+            return False
+        self.restartPool(pool)
+        isolated = ExportPool.make_pool(1, self.configs.get("python"))
+        retry = isolated.submit(fn, payload)
+        futures[retry] = futures[future]
+        self.payloads[retry] = (fn, payload, isolated, True)
+        self.isolated[retry] = isolated
+        return True
+
+    def feed(self, deadline):
+        """Does the GUI thread's share of the export for one tick"""
+        import ExportPool
+        if self.budget_pass is not None:
+            for future in [f for f in self.budget_futures if f.done()]:
+                retried = self.retried(future, self.budget_futures)
+                name = self.budget_futures.pop(future)
+                if retried:
+                    continue
+                if future.exception() is not None:
+                    # the part fails, and is reported, with its package job
+                    FreeCAD.Console.PrintError("Counting the triangles of %s failed: %s\n"
+                                               % (name, future.exception()))
+                    continue
+                self.budget_total += future.result()
+            if self.budget_parts is not None:
+                configs = dict(self.configs, quality_scale=self.budget_scale)
+                for obj in self.sliced(self.budget_parts, deadline, self.poolFull):
+                    try:
+                        self.checkUnchanged(obj)
+                        payload = {"brep": self.breps.get(obj), "configs": configs}
+                    except Exception:
+                        continue
+                    self.submit(obj.Label, ExportPool.run_count, payload,
+                                self.budget_futures)
+                if self.drained:
+                    self.budget_parts = None
+            if self.budget_parts is None and not self.budget_futures:
+                self.fitBudget()
+
+        if self.jobs is not None:
+            try:
+                for job in self.sliced(self.jobs, deadline, self.poolFull):
+                    payload = ExportPool.serialize_job(job, self.breps)
+                    payload["progress"] = self.progress
+                    payload["check_manifest"] = bool(self.configs.get("incremental"))
+                    self.submit(job["name"], ExportPool.run_job, payload, self.in_flight)
+                    self.setStage(job["name"], "queued")
+            except Exception as e:
+                self.partFailed(self.labels[id(self.current)], e)
+                if self.assembly is not None:
+                    self.assembly = [part for part in self.assembly
+                                     if part["obj"] is not self.current]
+                self.makeJobs()
+                return
+            if self.drained:
+                self.jobs = None
+                if self.assembly:
+                    self.assembly_entries = ExportPool.assembly_entries(
+                        self.checkedAssembly(), self.breps)
+                    self.assembly_payload = {"name": self.assembly_name, "parts": [],
+                                             "export_dir": self.export_dir,
+                                             "configs": self.configs}
+                elif self.assembly is not None:
+                    self.partFailed(self.assembly_name,
+                                    "None of its parts could be exported")
+
+        if self.assembly_entries is not None:
+            try:
+                self.assembly_payload["parts"].extend(
+                    self.sliced(self.assembly_entries, deadline))
+            except Exception as e:
+                self.assembly_entries = None
+                self.partFailed(self.assembly_name, e)
+                return
+            if self.drained:
+                self.assembly_entries = None
+                self.submit(self.assembly_name, ExportPool.run_assembly,
+                            self.assembly_payload, self.in_flight)
+                self.setStage(self.assembly_name, "queued")
+
+    def poll(self):
+        """Shows the stages reported by the workers and the finished jobs,
+        then hands the workers more jobs."""
+        try:
+            self.update()
+        except Exception as e:
+            # an error escaping the timer slot would stop the export silently
+            ended = [STAGES[stage] for stage in ("done", "up_to_date", "failed")]
+            for name, item in self.items.items():
+                if item.text(1) not in ended:
+                    self.setStage(name, "failed")
+            self.finish("Export failed: %s" % e)
+
+    def update(self):
+        while True:
+            try:
+                name, stage = self.progress.get_nowait()
+            except queue.Empty:
+                break
+            # late reports of finished jobs are dropped
+            if name in self.in_flight.values():
+                self.setStage(name, stage)
+
+        for future, name in list(self.in_flight.items()):
+            if not future.done():
+                continue
+            retried = self.retried(future, self.in_flight)
+            del self.in_flight[future]
+            if retried:
+                continue
+            if future.cancelled():
+                self.finished_count += 1
+                self.setStage(name, "cancelled")
+            elif future.exception() is not None:
+                self.partFailed(name, future.exception())
+            elif future.result()[1] is None:
+                self.finished_count += 1
+                self.skipped += 1
+                self.setStage(name, "up_to_date")
+            else:
+                self.finished_count += 1
+                self.setStage(name, "done")
+        self.form.ProgressBar.setValue(self.finished_count)
+
+        self.feed(time.monotonic() + SLICE)
+        if self.finished:
+            return
+        working = (self.budget_pass is not None or self.jobs is not None
+                   or self.assembly_entries is not None)
+        if not working and not self.in_flight:
+            self.finish("Exported %d packages to %s, %d up to date, %d failed"
+                        % (self.finished_count - self.failed - self.skipped,
+                           self.export_dir, self.skipped, self.failed))
+
+    def finish(self, message):
+        self.timer.stop()
+        self.finished = True
+        self.pool.shutdown(wait=False)
+        for pool in self.isolated.values():
+            pool.shutdown(wait=False)
+        self.manager.shutdown()
+        self.form.StatusLabel.setText(message)
+        FreeCAD.Console.PrintMessage(message + "\n")
+
+    def cancel(self):
+        """Drops the jobs that have not started. Running jobs complete in
+        their workers, so no package is left half written."""
+        self.budget_pass = self.budget_parts = None
+        for future in self.budget_futures:
+            future.cancel()
+        self.jobs = self.assembly_entries = None
+        for future, name in self.in_flight.items():
+            if future.cancel():
+                self.setStage(name, "cancelled")
+        for name, item in self.items.items():
+            if item.text(1) == STAGES["waiting"]:
+                self.setStage(name, "cancelled")
+        self.finish("Export cancelled")
+
+    def getStandardButtons(self):
+        return int(QtGui.QDialogButtonBox.Close)
+
+    def reject(self):
+        if not self.finished:
+            self.cancel()
+        FreeCADGui.Control.closeDialog()
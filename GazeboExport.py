@@ -1,21 +1,22 @@
-import FreeCAD, Mesh, os, numpy as np
-import yaml
-import argparse
-import collada
+import FreeCAD, os, numpy as np
+import itertools, hashlib, shutil, io, gzip
+import json
 from xml.etree import ElementTree as ET
-from xml.dom.minidom import parseString
+from xml.sax.saxutils import escape
 from math import radians as _radians
 import Part
 
 # Takes subassembly or parts dictionary { part_label: { "obj": <obj>, "mesh": <meshuri> } }
-# and generate SDF for them
+# with meshes in the part frames and generate SDF for them, a link per part
+# at its placement, an optional "collision" mesh or detect_primitive
+# "primitive" replaces "mesh" for collisions, an optional "shape_hash" keys
+# the mass properties of the part in mass_cache
 
-def export_sdf(objects, export_dir, modelname, configs={}):
+def export_sdf(objects, export_dir, modelname, configs={}, mass_cache=None):
     model_dir = os.path.join(export_dir, modelname)
 
     scale = configs.get('scale', 0.001)
     scale_vec = FreeCAD.Vector([scale]*3)
-    density = configs.get('density', 1000)
 
     shapes = list(map(lambda x: x["obj"].Shape, objects.values()))
     bounding_box = Part.makeCompound(shapes).BoundBox
@@ -31,24 +32,31 @@ def export_sdf(objects, export_dir, modelname, configs={}):
     model.self_collide = False
     model.sdf_version = '1.5'
 
+    inertials = link_inertials([part["obj"] for part in objects.values()], configs,
+                               mass_cache, {part["obj"].Label: part.get("shape_hash")
+                                            for part in objects.values()})
     for label in objects.keys():
         shape = objects[label]["obj"].Shape
-        mass = shape.Mass * scale**3 * density
-        com = shape.CenterOfMass * scale
-        inr = shape.MatrixOfInertia
-        inr.scale(*scale_vec*(scale**4) * density)
+        properties = inertials[objects[label]["obj"].Label]
+        # the link sits in the part frame, where the meshes, primitives
+        # and the center of mass are given
         placement = shape.Placement
-        placement.Base.scale(*scale_vec)
-        pose = placement.copy()
-        pose.Base = com
-        pose_rpy = pose.copy()
-        pose_rpy.Base=(np.zeros(3))
-        inertia = Inertia(inertia=np.array(inr.A)[[0,1,2,5,6,10]])
-        inertial = Inertial(pose=pose_rpy, mass=mass, inertia=inertia)
+        pose = FreeCAD.Placement(placement.Base * scale, placement.Rotation)
+        inertia = Inertia(inertia=inertia_elements(properties["inertia"]))
+        inertial = Inertial(pose=FreeCAD.Placement(properties["com"], properties["rotation"]),
+                            mass=properties["mass"], inertia=inertia)
 
         mesh_uri = os.path.normpath(os.path.relpath(objects[label]["mesh"], export_dir))
+        collision_mesh = objects[label].get("collision", objects[label]["mesh"])
+        collision_uri = os.path.normpath(os.path.relpath(collision_mesh, export_dir))
         visual = Visual(name=label+'_visual', mesh=mesh_uri)
-        collision = Collision(name=label+'_collision', mesh=mesh_uri)
+        primitive = objects[label].get("primitive")
+        if primitive:
+            primitive = scale_primitive(primitive, scale)
+            collision = Collision(name=label+'_collision', pose=primitive.pop("pose"),
+                                  primitive=primitive)
+        else:
+            collision = Collision(name=label+'_collision', mesh=collision_uri)
 
         link = Link(name=label,
                     pose=pose,
@@ -58,7 +66,221 @@ def export_sdf(objects, export_dir, modelname, configs={}):
         model.links.append(link)
 
     with open(os.path.join(model_dir, 'model.sdf'), 'w') as sdf_file:
-        sdf_file.write(model.to_xml_string('sdf'))
+        model.write(sdf_file, 'sdf', pretty=configs.get('pretty_xml', True))
+
+# Settings of export_package and their defaults
+PACKAGE_SETTINGS = {'shared_meshes': None,
+                    'scale': 0.001,
+                    'mesh_format': 'dae',
+                    'quality': 1,
+                    'adaptive_quality': None,
+                    'angular_deflection': None,
+                    'quality_scale': 1,
+                    'lod_tiers': [],
+                    'collision': None,
+                    'collision_triangles': 1000,
+                    'primitive_collisions': False,
+                    'primitive_tolerance': 0.01,
+                    'pretty_xml': True,
+                    'weld_tolerance': None,
+                    'weld_normal_tolerance': 1e-4,
+                    'mesh_archive': False,
+                    'density': 1000,
+                    'densities': {},
+                    'inertia_backend': 'exact',
+                    'principal_inertia': False}
+
+
+def package_settings(configs={}):
+    '''The export_package settings in configs, defaults filled in'''
+    return {key: configs.get(key, default)
+            for key, default in PACKAGE_SETTINGS.items()}
+
+
+def weld_settings(configs={}):
+    '''The weld argument of export_arrays for configs, None not to weld'''
+    if not configs.get('weld_tolerance'):
+        return None
+    return (configs['weld_tolerance'],
+            configs.get('weld_normal_tolerance', PACKAGE_SETTINGS['weld_normal_tolerance']))
+
+
+def export_package(name, part, export_dir, frames, manifest=None, configs={},
+                   cache=None, mass_cache=None, progress=None):
+    '''Writes the Gazebo package <export_dir>/<name> of a single part:
+    its mesh, model.sdf, model.config, frames.json and manifest.json
+    part - { "obj": <obj>, "mesh": <mesh path>, "shape_hash": <digest> }
+    frames - contents of frames.json
+    manifest - inputs of the package, written to manifest.json if given
+    configs["shared_meshes"] - "hardlink" or "uri" to use a MeshStore
+    configs["mesh_format"] - one of MESH_FORMATS, "dae" by default
+    configs["scale"] - scale of the meshes and the model, from document
+    units to meters, 0.001 by default
+    configs["mesh_archive"] - also write the mesh as a .qmz archive,
+    <name>.qmz next to the meshes, which the model does not refer to
+    configs["quality"], configs["adaptive_quality"] - see part_quality
+    configs["lod_tiers"] - linear deflection factors of additional,
+    coarser meshes <name>_lod1, <name>_lod2, ...
+    configs["collision"] - "decimate" or "hull" for a separate collision
+    mesh of at most configs["collision_triangles"] triangles, "lod" to
+    collide with the coarsest level of detail
+    configs["primitive_collisions"] - use detect_primitive boxes, cylinders
+    and spheres within configs["primitive_tolerance"] as collisions
+    configs["density"], configs["densities"] - see link_inertials
+    configs["weld_tolerance"] - weld_arrays the meshes, welding vertices
+    within this distance in meters and normals within
+    configs["weld_normal_tolerance"]
+    progress - called with "mesh", "lod", "collision" and "model" as
+    these stages start
+    All meshes are written in the part frame, see export_sdf
+    returns the path of the mesh the package uses'''
+    if progress is None:
+        progress = lambda stage: None
+    model_dir = os.path.join(export_dir, name)
+    mesh_dir = os.path.join(model_dir, 'meshes')
+    os.makedirs(mesh_dir, exist_ok=True)
+
+    shared_meshes = configs.get('shared_meshes')
+    mesh_format = configs.get('mesh_format', 'dae')
+    scale = configs.get('scale', 0.001)
+    weld = weld_settings(configs)
+    # the part is copied and hashed once, every mesh is keyed by its digest
+    shape = part_shape(part["obj"], local=True)
+    digest = part.get("shape_hash") or shape_hash(shape)
+    digests = {part["obj"].Label: digest}
+    quality = part_quality(shape, configs)
+    progress("mesh")
+    if shared_meshes:
+        mesh_store = MeshStore(export_dir, cache=cache, scale=scale, quality=quality,
+                               mesh_format=mesh_format, weld=weld)
+        mesh_file = mesh_store.add(part["obj"], digest)
+        if shared_meshes == 'hardlink':
+            link = os.path.join(mesh_dir, os.path.basename(mesh_file))
+            link_file(mesh_file, link)
+            mesh_file = link
+    else:
+        mesh_file = os.path.splitext(part["mesh"])[0] + '.' + mesh_format
+        export_mesh([part["obj"]], mesh_file, mesh_format, scale=scale,
+                    quality=quality, per_face=True, cache=cache, local=True, weld=weld,
+                    digests=digests)
+    sdf_part = {"obj": part["obj"], "mesh": mesh_file, "shape_hash": digest}
+    if configs.get('mesh_archive'):
+        export_archive([part["obj"]], os.path.join(mesh_dir, name + '.qmz'),
+                       scale=scale, quality=quality, per_face=True, cache=cache,
+                       local=True, weld=weld, digests=digests)
+
+    # coarser levels of detail next to the mesh, <name>_lod<tier>
+    lod_files = []
+    if configs.get('lod_tiers'):
+        progress("lod")
+    for tier, factor in enumerate(configs.get('lod_tiers', []), 1):
+        lod_file = os.path.join(mesh_dir, '%s_lod%d.%s' % (name, tier, mesh_format))
+        export_mesh([part["obj"]], lod_file, mesh_format, scale=scale,
+                    quality=scale_quality(quality, factor),
+                    per_face=True, cache=cache, local=True, weld=weld,
+                    digests=digests)
+        lod_files.append(lod_file)
+
+    if configs.get('primitive_collisions') or configs.get('collision'):
+        progress("collision")
+    if configs.get('primitive_collisions'):
+        sdf_part["primitive"] = detect_primitive(shape, configs.get('primitive_tolerance', 0.01))
+    collision = configs.get('collision')
+    if collision == 'lod' and lod_files and not sdf_part.get("primitive"):
+        sdf_part["collision"] = lod_files[-1]
+    elif collision and collision != 'lod' and not sdf_part.get("primitive"):
+        collision_file = os.path.join(mesh_dir, name + '_collision.' + mesh_format)
+        export_collision([part["obj"]], collision_file, collision,
+                         configs.get('collision_triangles', 1000), mesh_format,
+                         scale=scale, quality=quality, per_face=True, cache=cache,
+                         local=True, weld=weld, digests=digests)
+        sdf_part["collision"] = collision_file
+    progress("model")
+    export_sdf({name: sdf_part}, export_dir, name, configs, mass_cache)
+
+    with open(os.path.join(model_dir, 'model.config'), 'w') as config_file:
+        config_file.write(config(name,
+            'model.sdf', 'Author', 'Email', 'Comment', 'Version'))
+
+    with open(os.path.join(model_dir, 'frames.json'), 'w') as frames_file:
+        json.dump(frames, frames_file, indent=1, separators=(',', ': '))
+
+    if manifest is not None:
+        # the manifest owns the mesh content it was written with
+        manifest = dict(manifest, mesh=os.path.relpath(mesh_file, export_dir),
+                        mesh_digest=file_digest(mesh_file))
+        with open(os.path.join(model_dir, 'manifest.json'), 'w') as manifest_file:
+            json.dump(manifest, manifest_file, indent=1, separators=(',', ': '))
+    return mesh_file
+
+def export_assembly(name, parts, export_dir, configs={}, cache=None,
+                    mass_cache=None):
+    '''Writes one Gazebo package <export_dir>/<name> for a list of parts:
+    a single model with a link per part at its document placement, each
+    fixed to the first link, and one mesh per unique shape in
+    <name>/meshes that identical links share
+    parts - [{ "obj": <obj>, "shape_hash": <digest> }, ...]
+    configs["assembly_format"] - "sdf" (default) or "urdf", written as
+    model.sdf or model.urdf
+    returns the path of the model file'''
+    scale = configs.get('scale', 0.001)
+    fmt = configs.get('assembly_format', 'sdf')
+    mesh_format = configs.get('mesh_format', 'dae')
+    model_dir = os.path.join(export_dir, name)
+
+    model = Model(name=name)
+    model.self_collide = False
+    model.sdf_version = '1.5'
+    # straight up axis, fixed joints ignore it but sdf rejects a zero one
+    fixed_axis = Axis(pose=FreeCAD.Placement(FreeCAD.Vector(0, 0, 1), FreeCAD.Rotation()))
+    inertials = link_inertials([part["obj"] for part in parts], configs, mass_cache,
+                               {part["obj"].Label: part.get("shape_hash")
+                                for part in parts})
+
+    for part in parts:
+        obj = part["obj"]
+        label = obj.Label
+        shape = part_shape(obj, local=True)
+        mesh_store = MeshStore(export_dir, name, cache=cache, scale=scale,
+                               quality=part_quality(shape, configs),
+                               mesh_format=mesh_format,
+                               weld=weld_settings(configs))
+        mesh_file = mesh_store.add(obj, part.get("shape_hash"))
+        mesh_uri = os.path.normpath(os.path.relpath(mesh_file, export_dir))
+
+        # links sit in the part frame, the meshes are local to it
+        properties = inertials[label]
+        inertial = Inertial(pose=FreeCAD.Placement(properties["com"], properties["rotation"]),
+                            mass=properties["mass"],
+                            inertia=Inertia(inertia=inertia_elements(properties["inertia"])))
+        placement = obj.Placement
+        pose = FreeCAD.Placement(placement.Base * scale, placement.Rotation)
+
+        visual = Visual(name=label+'_visual', mesh=mesh_uri)
+        primitive = None
+        if configs.get('primitive_collisions'):
+            primitive = detect_primitive(shape, configs.get('primitive_tolerance', 0.01))
+        if primitive:
+            primitive = scale_primitive(primitive, scale)
+            collision = Collision(name=label+'_collision', pose=primitive.pop("pose"),
+                                  primitive=primitive)
+        else:
+            collision = Collision(name=label+'_collision', mesh=mesh_uri)
+        model.links.append(Link(name=label, pose=pose, inertial=inertial,
+                                visual=visual, collision=collision))
+
+        if len(model.links) > 1:
+            model.joints.append(Joint(name=label+'_fixed', type='fixed',
+                                      parent=model.links[0].name, child=label,
+                                      axis=fixed_axis))
+
+    model_file = os.path.join(model_dir, 'model.' + fmt)
+    with open(model_file, 'w') as out:
+        model.write(out, fmt, pretty=configs.get('pretty_xml', True))
+    with open(os.path.join(model_dir, 'model.config'), 'w') as config_file:
+        config_file.write(config(name,
+            'model.' + fmt, 'Author', 'Email', 'Comment', 'Version'))
+    return model_file
 
 ###################################################################
 # Export helpers
@@ -66,85 +288,618 @@ def export_sdf(objects, export_dir, modelname, configs={}):
 
 
 
-def export_collada(exportList, filename, scale=0.001, quality=1, offset=np.zeros(3)):
-    '''FreeCAD collada exporter
-    exportList - list of objects
-    scale - scaling factor for the mesh
-    quality - mesh tessellation quality
-    offset - offset of the origin of the resulting mesh'''
+def flat_array(items, dtype=np.float64, width=3):
+    '''Packs a sequence of fixed-size items (vectors, index tuples)
+    into a contiguous (N, width) array without intermediate lists'''
+    return np.fromiter(itertools.chain.from_iterable(items), dtype=dtype,
+                       count=width*len(items)).reshape(-1, width)
+
+
+def vertex_normals(points, triangles):
+    '''Unit normals at the points of a triangle mesh, the area weighted
+    mean of the normals of the triangles around each point'''
+    corners = points[triangles]
+    facets = np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0])
+    normals = np.zeros_like(points)
+    for i in range(3):
+        np.add.at(normals, triangles[:, i], facets)
+    lengths = np.linalg.norm(normals, axis=1)
+    lengths[lengths == 0] = 1
+    return normals / lengths[:, None]
+
+
+def surface_normals(surface, points):
+    '''Unit normals of planes, cylinders, cones, spheres and tori at (N, 3)
+    points on them, evaluated in batch, None for other surfaces. They
+    point away from the axis or center, whatever the face orientation'''
+    if isinstance(surface, Part.Plane):
+        return np.tile(np.array(tuple(surface.Axis)), (len(points), 1))
+    if isinstance(surface, Part.Sphere):
+        normals = points - np.array(tuple(surface.Center))
+    elif isinstance(surface, (Part.Cylinder, Part.Cone, Part.Toroid)):
+        axis = np.array(tuple(surface.Axis))
+        origin = surface.Apex if isinstance(surface, Part.Cone) else surface.Center
+        offsets = points - np.array(tuple(origin))
+        radial = offsets - np.outer(offsets.dot(axis), axis)
+        lengths = np.linalg.norm(radial, axis=1)
+        lengths[lengths == 0] = 1
+        radial /= lengths[:, None]
+        if isinstance(surface, Part.Cylinder):
+            normals = radial
+        elif isinstance(surface, Part.Cone):
+            angle = surface.SemiAngle
+            normals = np.cos(angle) * radial - np.sin(angle) * axis
+        else:
+            # away from the closest point of the center circle
+            normals = offsets - surface.MajorRadius * radial
+    else:
+        return None
+    lengths = np.linalg.norm(normals, axis=1)
+    lengths[lengths == 0] = 1
+    return normals / lengths[:, None]
+
+
+def face_normals(face, points, triangles):
+    '''Unit surface normals of a face at its (N, 3) tessellation points
+    and (M, 3) triangles. Analytic surfaces are evaluated in batch and
+    oriented like the face, other surfaces at the UV nodes of the same
+    triangulation. Where the UV nodes do not match the points, in count
+    or at the ends, the normals are averaged from the triangles instead'''
+    surface = face.Surface
+    normals = surface_normals(surface, points)
+    if normals is not None:
+        # follow the face orientation, which may point inwards
+        u, v = surface.parameter(FreeCAD.Vector(*points[0]))
+        if normals[0].dot(np.array(tuple(face.normalAt(u, v)))) < 0:
+            normals *= -1
+        return normals
+
+    uvs = face.getUVNodes() if hasattr(face, 'getUVNodes') else []
+    if len(uvs) != len(points) or not all(
+            np.allclose(tuple(face.valueAt(*uvs[i])), points[i], atol=1e-6)
+            for i in (0, -1)):
+        return vertex_normals(points, triangles)
+    return flat_array([face.normalAt(u, v) for u, v in uvs])
+
+
+def linear_deflection(shape, quality):
+    '''Returns the linear deflection of a quality, either a number or a
+    (linear, angular) deflection pair. For pairs the shape is meshed with
+    the angular deflection first, later tessellate calls with the linear
+    deflection keep that finer triangulation. The shape must be a
+    bare_shape, meshed at no other quality before'''
+    if not isinstance(quality, (tuple, list)):
+        return quality
+    import MeshPart
+    linear, angular = quality
+    MeshPart.meshFromShape(Shape=shape, LinearDeflection=linear,
+                           AngularDeflection=angular, Relative=False)
+    return linear
+
+
+def scale_quality(quality, factor):
+    '''Coarsens the linear deflection of a quality by factor'''
+    if isinstance(quality, (tuple, list)):
+        return (quality[0] * factor, quality[1])
+    return quality * factor
+
+
+def part_quality(shape, configs={}):
+    '''Tessellation quality of a part: configs["quality"], or with
+    configs["adaptive_quality"] a linear deflection of that fraction of the
+    bounding box diagonal, times configs["quality_scale"], paired with
+    configs["angular_deflection"] when set'''
+    relative = configs.get('adaptive_quality')
+    if not relative:
+        return configs.get('quality', 1)
+    linear = shape.BoundBox.DiagonalLength * relative * configs.get('quality_scale', 1)
+    angular = configs.get('angular_deflection')
+    return (linear, angular) if angular else linear
+
+
+# counting passes of fit_triangle_budget
+BUDGET_PASSES = 3
+
+
+def triangle_count(shape, configs={}):
+    '''Triangles of the main mesh of a shape in its part frame at its
+    part_quality'''
+    quality = part_quality(shape, configs)
+    # a bare copy per count, the finer mesh of an earlier count would be kept
+    shape = bare_shape(shape)
+    return len(shape.tessellate(linear_deflection(shape, quality))[1])
+
+
+def next_quality_scale(total, budget, quality_scale):
+    '''Estimate of the configs["quality_scale"] at which main meshes of
+    total triangles at quality_scale fit a budget. The triangle count of a
+    mesh is roughly inversely proportional to its linear deflection'''
+    return quality_scale * 1.1 * total / budget
+
+
+def warn_over_budget(total, budget):
+    FreeCAD.Console.PrintWarning("The meshes keep %d triangles, over the triangle "
+                                 "budget of %d\n" % (total, budget))
+
+
+def fit_triangle_budget(shapes, configs, budget, passes=BUDGET_PASSES):
+    '''Finds the configs["quality_scale"] at which the main meshes of the
+    adaptive tessellation of all shapes have at most budget triangles in
+    total. LOD tiers and collision meshes are not counted, they come on
+    top of the budget.
+    shapes - function returning an iterable of the shapes in their part
+    frames, called once per counting pass, so that the shapes can be built
+    one at a time
+    The scale returned is always counted; if it still exceeds the budget
+    after the passes a warning is printed'''
+    quality_scale = configs.get('quality_scale', 1)
+    for i in range(passes):
+        scaled = dict(configs, quality_scale=quality_scale)
+        total = sum(triangle_count(shape, scaled) for shape in shapes())
+        if total <= budget:
+            return quality_scale
+        if i < passes - 1:
+            quality_scale = next_quality_scale(total, budget, quality_scale)
+    warn_over_budget(total, budget)
+    return quality_scale
+
+
+def shape_arrays(shape, quality=1):
+    '''Tessellates every face of a shape exactly once and returns
+    (points, normals, triangles) with one true surface normal per point'''
+    quality = linear_deflection(shape, quality)
+    points = []
+    normals = []
+    triangles = []
+    count = 0
+    for face in shape.Faces:
+        face_points, face_triangles = face.tessellate(quality)
+        if not face_triangles:
+            continue
+        face_points = flat_array(face_points)
+        points.append(face_points)
+        face_triangles = flat_array(face_triangles, dtype=np.int32)
+        normals.append(face_normals(face, face_points, face_triangles))
+        triangles.append(face_triangles + count)
+        count += len(face_points)
+
+    if not triangles:
+        return np.zeros((0, 3)), np.zeros((0, 3)), np.zeros((0, 3), dtype=np.int32)
+    return np.concatenate(points), np.concatenate(normals), np.concatenate(triangles)
+
+
+def bare_shape(shape):
+    '''Copy of a shape without stored triangulations. OCCT keeps a finer
+    triangulation when asked for a coarser one, so every tessellation at
+    a new quality starts from a bare copy, which also leaves the
+    document shapes untouched'''
+    try:
+        return shape.copy(True, False)
+    except TypeError:
+        return shape.copy()
+
+
+def part_shape(obj, local=False):
+    '''bare_shape of a Part feature, in its own part frame if local'''
+    shape = bare_shape(obj.Shape)
+    if local:
+        shape.Placement = FreeCAD.Placement()
+    return shape
+
+
+def mesh_arrays(obj, scale=0.001, quality=1, offset=np.zeros(3), per_face=False,
+                local=False):
+    '''Tessellates a Part or Mesh feature into contiguous NumPy arrays
+    returns (vertices, normals, triangles, normal_indices) with vertices
+    and normals as (N, 3) float arrays and the index arrays as (M, 3) ints,
+    or None if the object is neither a Part::Feature nor a Mesh::Feature
+    per_face - tessellate Part faces one by one with per-vertex normals
+    local - tessellate Part features in their part frame'''
+    if obj.isDerivedFrom("Part::Feature") and per_face:
+        vertices, normals, triangles = shape_arrays(part_shape(obj, local), quality)
+        vertices *= scale
+        vertices += offset
+        return vertices, normals, triangles, triangles
+    elif obj.isDerivedFrom("Part::Feature"):
+        shape = part_shape(obj, local)
+        quality = linear_deflection(shape, quality)
+        points, triangles = shape.tessellate(quality)
+        # one flat normal per face, repeated for each of its triangles
+        faces = shape.Faces
+        counts = np.fromiter((len(f.tessellate(quality)[1]) for f in faces),
+                             dtype=np.int64, count=len(faces))
+        face_normals = flat_array([f.normalAt(0,0) for f in faces])
+        normals = np.repeat(face_normals, counts, axis=0)
+    elif obj.isDerivedFrom("Mesh::Feature"):
+        print("exporting mesh ",obj.Name, obj.Mesh)
+        points, triangles = obj.Mesh.Topology
+        normals = flat_array([f.Normal for f in obj.Mesh.Facets])
+    else:
+        return None
+
+    vertices = flat_array(points)
+    vertices *= scale
+    vertices += offset
+    triangles = flat_array(triangles, dtype=np.int32)
+    normal_indices = np.repeat(np.arange(len(triangles), dtype=np.int32),
+                               3).reshape(-1, 3)
+    return vertices, normals, triangles, normal_indices
+
+
+def shape_hash(shape, *settings):
+    '''Stable hex digest of the BREP content of a shape and any export
+    settings that influence what is derived from it'''
+    # stored triangulations would change the BREP text
+    return brep_digest(bare_shape(shape).exportBrepToString(), *settings)
+
+
+def brep_digest(brep, *settings):
+    '''shape_hash of a shape serialized with exportBrepToString'''
+    digest = hashlib.sha1(brep.encode())
+    for setting in settings:
+        digest.update(repr(setting).encode())
+    return digest.hexdigest()
+
+
+def file_digest(path):
+    '''Hex digest of the contents of a file'''
+    digest = hashlib.sha1()
+    with open(path, 'rb') as digest_file:
+        for block in iter(lambda: digest_file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def cache_dir(name):
+    '''Directory for the persistent caches of the export'''
+    if hasattr(FreeCAD, 'getUserCachePath'):
+        base = FreeCAD.getUserCachePath()
+    else:
+        base = FreeCAD.getUserAppDataDir()
+    return os.path.join(base, 'ARBench', name)
+
+
+class TessellationCache(object):
+    '''On-disk cache of mesh_arrays results. Every entry is a directory of
+    .npy files that are memory-mapped when read; entries are evicted in
+    least recently used order once the cache exceeds max_bytes. The
+    directory is scanned once, later puts keep a running size index'''
+    def __init__(self, directory=None, max_bytes=2*1024**3):
+        self.directory = directory or cache_dir('tessellation')
+        self.max_bytes = max_bytes
+        self.entries = None
+        self.total = 0
+        os.makedirs(self.directory, exist_ok=True)
+
+    def key(self, obj, scale, quality, per_face, local=False, digest=None):
+        '''Entry of the mesh of obj. In the part frame the entry follows
+        from the shape_hash of the part, hashed here unless given as digest'''
+        if not local:
+            return shape_hash(part_shape(obj), scale, quality, per_face)
+        if digest is None:
+            digest = shape_hash(part_shape(obj, local=True))
+        return hashlib.sha1((digest + repr((scale, quality, per_face))).encode()).hexdigest()
+
+    def get(self, key):
+        '''Returns the cached arrays of an entry or None on a miss'''
+        entry = os.path.join(self.directory, key)
+        try:
+            arrays = tuple(np.load(os.path.join(entry, '%d.npy' % i), mmap_mode='r')
+                           for i in range(4))
+            os.utime(entry)
+        except (OSError, ValueError):
+            return None
+        if self.entries is not None and entry in self.entries:
+            self.entries[entry][0] = os.stat(entry).st_mtime
+        return arrays
+
+    def put(self, key, arrays):
+        '''Stores the arrays of an entry and evicts old entries'''
+        entry = os.path.join(self.directory, key)
+        tmp = '%s.tmp%d' % (entry, os.getpid())
+        os.makedirs(tmp, exist_ok=True)
+        for i, array in enumerate(arrays):
+            np.save(os.path.join(tmp, '%d.npy' % i), np.ascontiguousarray(array))
+        try:
+            os.rename(tmp, entry)
+        except OSError:
+            # stored concurrently by another export
+            shutil.rmtree(tmp, ignore_errors=True)
+        entries = self.index()
+        if entry not in entries and os.path.isdir(entry):
+            size = sum(f.stat().st_size for f in os.scandir(entry))
+            entries[entry] = [os.stat(entry).st_mtime, size]
+            self.total += size
+        if self.total > self.max_bytes:
+            self.evict()
+
+    def index(self):
+        '''{ entry: [mtime, size] } of the cache directory, scanned on
+        first use'''
+        if self.entries is None:
+            self.entries = {}
+            self.total = 0
+            for entry in os.scandir(self.directory):
+                if not entry.is_dir() or '.tmp' in entry.name:
+                    continue
+                size = sum(f.stat().st_size for f in os.scandir(entry.path))
+                self.entries[entry.path] = [entry.stat().st_mtime, size]
+                self.total += size
+        return self.entries
+
+    def evict(self):
+        '''Removes least recently used entries until within max_bytes'''
+        entries = self.index()
+        for path, (mtime, size) in sorted(entries.items(), key=lambda e: e[1][0]):
+            if self.total <= self.max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            del entries[path]
+            self.total -= size
+
+
+def cached_mesh_arrays(obj, cache, scale=0.001, quality=1, offset=np.zeros(3),
+                       per_face=False, local=False, digest=None):
+    '''mesh_arrays backed by a TessellationCache for Part features
+    digest - shape_hash of obj in its part frame, if known'''
+    if not obj.isDerivedFrom("Part::Feature"):
+        return mesh_arrays(obj, scale, quality, offset, per_face)
+
+    key = cache.key(obj, scale, quality, per_face, local, digest)
+    arrays = cache.get(key)
+    if arrays is None:
+        arrays = mesh_arrays(obj, scale, quality, per_face=per_face, local=local)
+        cache.put(key, arrays)
+    if np.any(offset):
+        arrays = (arrays[0] + offset,) + tuple(arrays[1:])
+    return arrays
+
+
+def link_file(source, target):
+    '''Hardlinks source to target, copying when linking is not possible'''
+    if os.path.lexists(target):
+        os.remove(target)
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copyfile(source, target)
+
+
+class MeshStore(object):
+    '''Content-addressed store of part meshes. Each unique shape is written
+    once, in its part frame, as <directory>/<name>/meshes/<hash>.dae so
+    that packages can hardlink it or refer to it as
+    model://<name>/meshes/<hash>.dae'''
+    def __init__(self, directory, name='arbench_meshes', cache=None,
+                 scale=0.001, quality=1, per_face=True, mesh_format='dae', weld=None):
+        self.mesh_dir = os.path.join(directory, name, 'meshes')
+        self.cache = cache
+        self.mesh_format = mesh_format
+        self.settings = {'scale': scale, 'quality': quality, 'per_face': per_face,
+                         'weld': weld}
+        os.makedirs(self.mesh_dir, exist_ok=True)
+
+    def path(self, digest):
+        '''Path of the stored mesh of a shape with the given shape_hash'''
+        key = hashlib.sha1((digest + repr(sorted(self.settings.items()))).encode())
+        return os.path.join(self.mesh_dir, key.hexdigest() + '.' + self.mesh_format)
+
+    def add(self, obj, digest=None):
+        '''Stores the mesh of obj unless an identical one is already
+        stored and returns the path of the stored mesh
+        digest - shape_hash of the shape of obj in its part frame'''
+        if digest is None:
+            digest = shape_hash(part_shape(obj, local=True))
+        path = self.path(digest)
+        if not os.path.exists(path):
+            export_mesh([obj], path, self.mesh_format, local=True, cache=self.cache,
+                        digests={obj.Label: digest}, **self.settings)
+        return path
+
+
+def triangle_set_indices(triangles, normal_indices):
+    '''Interleaves vertex and normal indices into the
+    [v0, n0, v1, n1, v2, n2] layout expected by createTriangleSet'''
+    indices = np.empty((len(triangles), 6), dtype=np.int32)
+    indices[:, 0::2] = triangles
+    indices[:, 1::2] = normal_indices
+    return indices.ravel()
+
+
+def export_arrays(exportList, scale=0.001, quality=1, offset=np.zeros(3),
+                  per_face=False, cache=None, local=False, weld=None,
+                  digests=None):
+    '''Yields (index, obj, mesh_arrays) for every object of exportList
+    that can be tessellated, index being its position in exportList
+    weld - tolerance of weld_arrays or (tolerance, normal_tolerance), None
+    to keep the tessellation as is
+    digests - see export_collada'''
+    for objind, obj in enumerate(exportList):
+        if cache is not None:
+            arrays = cached_mesh_arrays(obj, cache, scale, quality, offset,
+                                        per_face, local,
+                                        (digests or {}).get(obj.Label))
+        else:
+            arrays = mesh_arrays(obj, scale, quality, offset, per_face, local)
+        if arrays is None:
+            continue
+        if weld:
+            arrays, saved = weld_arrays(arrays, *(weld if isinstance(weld, tuple)
+                                                  else (weld,)))
+            FreeCAD.Console.PrintMessage("Welded %s: %d vertices, %d triangles saved\n"
+                                         % (obj.Label, saved["vertices"],
+                                            saved["triangles"]))
+        yield objind, obj, arrays
+
+
+def vertex_attributes(vertices, normals, triangles, normal_indices):
+    '''Resolves separate vertex and normal indices into single-indexed
+    (positions, unit normals, triangles), as needed by glTF'''
+    if normal_indices is triangles or np.array_equal(normal_indices, triangles):
+        positions, vertex_normals, indices = vertices, normals, triangles
+    else:
+        pairs = np.stack([triangles.ravel(), normal_indices.ravel()], axis=1)
+        pairs, inverse = np.unique(pairs, axis=0, return_inverse=True)
+        positions = vertices[pairs[:, 0]]
+        vertex_normals = normals[pairs[:, 1]]
+        indices = inverse.reshape(-1, 3)
+    lengths = np.linalg.norm(vertex_normals, axis=1)
+    lengths[lengths == 0] = 1
+    return (np.ascontiguousarray(positions, dtype=np.float32),
+            np.ascontiguousarray(vertex_normals / lengths[:, None], dtype=np.float32),
+            np.ascontiguousarray(indices, dtype=np.uint32))
+
+
+STL_TRIANGLE = np.dtype([('normal', '<f4', (3,)),
+                         ('vertices', '<f4', (3, 3)),
+                         ('attributes', '<u2')])
+
+
+def facet_normals(vertices, triangles):
+    '''Unit normals of the triangles of a mesh'''
+    corners = vertices[triangles]
+    normals = np.cross(corners[:, 1] - corners[:, 0],
+                       corners[:, 2] - corners[:, 0])
+    lengths = np.linalg.norm(normals, axis=1)
+    lengths[lengths == 0] = 1
+    return normals / lengths[:, None]
+
+
+def write_stl(filename, meshes):
+    '''Writes (index, obj, mesh_arrays) items as one binary STL,
+    all objects merged into a triangle soup with facet normals'''
+    records = []
+    for objind, obj, arrays in meshes:
+        vertices, normals, triangles = arrays[:3]
+        record = np.zeros(len(triangles), dtype=STL_TRIANGLE)
+        record['normal'] = facet_normals(vertices, triangles)
+        record['vertices'] = vertices[triangles]
+        records.append(record)
+    records = np.concatenate(records) if records else np.zeros(0, dtype=STL_TRIANGLE)
+
+    with open(filename, 'wb') as stl_file:
+        stl_file.write(b'ARBench binary STL'.ljust(80, b' '))
+        stl_file.write(np.uint32(len(records)).tobytes())
+        records.tofile(stl_file)
+    print("file %s successfully created\n" % filename)
+
+
+def export_stl(exportList, filename, scale=0.001, quality=1, offset=np.zeros(3),
+               per_face=False, cache=None, local=False, weld=None,
+               digests=None):
+    '''Binary STL exporter, arguments as for export_collada'''
+    write_stl(filename, export_arrays(exportList, scale, quality, offset,
+                                      per_face, cache, local, weld, digests))
+
+
+# Column major rotation of -90 degrees about X, Z up to glTF's Y up
+GLTF_Z_UP = [1, 0, 0, 0,
+             0, 0, -1, 0,
+             0, 1, 0, 0,
+             0, 0, 0, 1]
+
+
+def write_glb(filename, meshes):
+    '''Writes (index, obj, mesh_arrays) items as binary glTF 2.0.
+    Every object becomes a mesh node. The vertices keep the Z up
+    coordinates of the other exporters, a root node turns them into the
+    Y up frame glTF requires'''
+    gltf = {"asset": {"version": "2.0", "generator": "ARBench"},
+            "scene": 0, "scenes": [{"nodes": [0]}],
+            "nodes": [{"name": "z_up", "matrix": GLTF_Z_UP, "children": []}],
+            "meshes": [], "accessors": [], "bufferViews": [], "buffers": []}
+    chunks = []
+    offset_bytes = 0
+
+    def add_view(array, target):
+        nonlocal offset_bytes
+        data = array.tobytes()
+        gltf["bufferViews"].append({"buffer": 0, "byteOffset": offset_bytes,
+                                    "byteLength": len(data), "target": target})
+        padding = -len(data) % 4
+        chunks.append(data + b'\x00' * padding)
+        offset_bytes += len(data) + padding
+        return len(gltf["bufferViews"]) - 1
+
+    for objind, obj, arrays in meshes:
+        positions, normals, indices = vertex_attributes(*arrays)
+        accessor = len(gltf["accessors"])
+        gltf["accessors"].extend([
+            {"bufferView": add_view(positions, 34962), "componentType": 5126,
+             "count": len(positions), "type": "VEC3",
+             "min": positions.min(axis=0).tolist() if len(positions) else [0]*3,
+             "max": positions.max(axis=0).tolist() if len(positions) else [0]*3},
+            {"bufferView": add_view(normals, 34962), "componentType": 5126,
+             "count": len(normals), "type": "VEC3"},
+            {"bufferView": add_view(indices, 34963), "componentType": 5125,
+             "count": indices.size, "type": "SCALAR"}])
+        gltf["meshes"].append({"name": obj.Label, "primitives": [
+            {"attributes": {"POSITION": accessor, "NORMAL": accessor + 1},
+             "indices": accessor + 2}]})
+        gltf["nodes"].append({"name": "node"+str(objind),
+                              "mesh": len(gltf["meshes"]) - 1})
+        gltf["nodes"][0]["children"].append(len(gltf["nodes"]) - 1)
+    gltf["buffers"].append({"byteLength": offset_bytes})
+    if not gltf["nodes"][0]["children"]:
+        # glTF allows no empty lists
+        del gltf["nodes"][0]["children"]
+
+    header = json.dumps(gltf, separators=(',', ':')).encode()
+    header += b' ' * (-len(header) % 4)
+    length = 12 + 8 + len(header) + 8 + offset_bytes
+    with open(filename, 'wb') as glb_file:
+        glb_file.write(np.array([0x46546C67, 2, length], dtype='<u4').tobytes())
+        glb_file.write(np.array([len(header), 0x4E4F534A], dtype='<u4').tobytes())
+        glb_file.write(header)
+        glb_file.write(np.array([offset_bytes, 0x004E4942], dtype='<u4').tobytes())
+        for chunk in chunks:
+            glb_file.write(chunk)
+    print("file %s successfully created\n" % filename)
 
+
+def export_glb(exportList, filename, scale=0.001, quality=1, offset=np.zeros(3),
+               per_face=False, cache=None, local=False, weld=None,
+               digests=None):
+    '''Binary glTF exporter, arguments as for export_collada'''
+    write_glb(filename, export_arrays(exportList, scale, quality, offset,
+                                      per_face, cache, local, weld, digests))
+
+
+def write_collada(filename, meshes):
+    '''Writes (index, obj, mesh_arrays) items as COLLADA'''
+    import collada
     colmesh = collada.Collada()
     colmesh.assetInfo.upaxis = collada.asset.UP_AXIS.Z_UP
-    objind = 0
     scenenodes = []
 
-    for obj in exportList:
-        bHandled = False
-        if obj.isDerivedFrom("Part::Feature"):
-            bHandled = True
-            m = obj.Shape.tessellate(quality)
-            vindex = []
-            nindex = []
-            findex = []
-            # vertex indices
-            for v in m[0]:
-                vindex.extend([a*scale+b for a, b in zip(v, offset)])
-            # normals
-            for f in obj.Shape.Faces:
-                n = f.normalAt(0,0)
-                for i in range(len(f.tessellate(quality)[1])):
-                    nindex.extend([n.x,n.y,n.z])
-            # face indices
-            for i in range(len(m[1])):
-                f = m[1][i]
-                findex.extend([f[0],i,f[1],i,f[2],i])
-        elif obj.isDerivedFrom("Mesh::Feature"):
-            bHandled = True
-            print("exporting mesh ",obj.Name, obj.Mesh)
-            m = obj.Mesh
-            vindex = []
-            nindex = []
-            findex = []
-            # vertex indices
-            for v in m.Topology[0]:
-                vindex.extend([a*scale+b for a, b in zip(v, offset)])
-            # normals
-            for f in m.Facets:
-                n = f.Normal
-                nindex.extend([n.x,n.y,n.z])
-            # face indices
-            for i in range(len(m.Topology[1])):
-                f = m.Topology[1][i]
-                findex.extend([f[0],i,f[1],i,f[2],i])
-
-        if bHandled:
-            vert_src = collada.source.FloatSource("cubeverts-array"+str(objind),
-                                                  np.array(vindex),
-                                                  ('X', 'Y', 'Z'))
-            normal_src = collada.source.FloatSource("cubenormals-array"+str(objind),
-                                                    np.array(nindex),
-                                                    ('X', 'Y', 'Z'))
-            geom = collada.geometry.Geometry(colmesh,
-                                             "geometry"+str(objind),
-                                             obj.Label,
-                                             [vert_src, normal_src])
-
-            input_list = collada.source.InputList()
-            input_list.addInput(0, 'VERTEX', "#cubeverts-array"+str(objind))
-            input_list.addInput(1, 'NORMAL', "#cubenormals-array"+str(objind))
-            triset = geom.createTriangleSet(np.array(findex),
-                                            input_list,
-                                            "materialref")
-            geom.primitives.append(triset)
-            colmesh.geometries.append(geom)
-
-            geomnode = collada.scene.GeometryNode(geom)
-            node = collada.scene.Node("node"+str(objind), children=[geomnode])
-
-            #TODO: Add materials handling
-            scenenodes.append(node)
-
-        objind += 1
+    for objind, obj, arrays in meshes:
+        vertices, normals, triangles, normal_indices = arrays
+        vert_src = collada.source.FloatSource("cubeverts-array"+str(objind),
+                                              vertices.ravel(),
+                                              ('X', 'Y', 'Z'))
+        normal_src = collada.source.FloatSource("cubenormals-array"+str(objind),
+                                                normals.ravel(),
+                                                ('X', 'Y', 'Z'))
+        geom = collada.geometry.Geometry(colmesh,
+                                         "geometry"+str(objind),
+                                         obj.Label,
+                                         [vert_src, normal_src])
+
+        input_list = collada.source.InputList()
+        input_list.addInput(0, 'VERTEX', "#cubeverts-array"+str(objind))
+        input_list.addInput(1, 'NORMAL', "#cubenormals-array"+str(objind))
+        triset = geom.createTriangleSet(triangle_set_indices(triangles,
+                                                             normal_indices),
+                                        input_list,
+                                        "materialref")
+        geom.primitives.append(triset)
+        colmesh.geometries.append(geom)
+
+        geomnode = collada.scene.GeometryNode(geom)
+        node = collada.scene.Node("node"+str(objind), children=[geomnode])
+
+        #TODO: Add materials handling
+        scenenodes.append(node)
 
     scene = collada.scene.Scene("scene", scenenodes)
     colmesh.scenes.append(scene)
@@ -154,6 +909,643 @@ def export_collada(exportList, filename, scale=0.001, quality=1, offset=np.zeros
     print("file %s successfully created\n" % filename)
 
 
+def export_collada(exportList, filename, scale=0.001, quality=1, offset=np.zeros(3),
+                   per_face=False, cache=None, local=False, weld=None,
+                   digests=None):
+    '''FreeCAD collada exporter
+    exportList - list of objects
+    scale - scaling factor for the mesh
+    quality - mesh tessellation quality, a linear deflection
+    or a (linear, angular) deflection pair
+    offset - offset of the origin of the resulting mesh
+    per_face - single tessellation pass with per-vertex normals
+    cache - TessellationCache to reuse meshes of unchanged shapes
+    local - mesh Part features in their part frame
+    weld - tolerance of weld_arrays in output units, None not to weld
+    digests - { label: shape_hash } of Part features in their part frames,
+    keys of the cache instead of hashing the shapes again'''
+    write_collada(filename, export_arrays(exportList, scale, quality, offset,
+                                          per_face, cache, local, weld, digests))
+
+
+# Compact archive format .qmz: gzip of b'ARBQ', the uint32 length of a
+# json header and, per mesh of the header, its positions quantized to
+# QMZ_POSITION_BITS on the grid of its bounding box, oct-encoded normals
+# and zigzag delta-encoded triangle and normal indices, all little endian
+QMZ_MAGIC = b'ARBQ'
+QMZ_POSITION_BITS = 16
+QMZ_NORMAL_BITS = 16
+
+
+def oct_encode(normals, bits=QMZ_NORMAL_BITS):
+    '''Octahedral encoding of unit normals as (N, 2) signed integers of
+    at most 16 bits'''
+    n = normals / np.maximum(np.abs(normals).sum(axis=1), 1e-30)[:, None]
+    xy = n[:, :2].copy()
+    below = n[:, 2] < 0
+    signs = np.where(xy[below] >= 0, 1.0, -1.0)
+    xy[below] = (1 - np.abs(xy[below][:, ::-1])) * signs
+    return np.round(xy * (2**(bits-1) - 1)).astype('<i2')
+
+
+def oct_decode(encoded, bits=QMZ_NORMAL_BITS):
+    '''Unit normals of oct_encode output'''
+    xy = encoded.astype(np.float64) / (2**(bits-1) - 1)
+    z = 1 - np.abs(xy).sum(axis=1)
+    below = z < 0
+    signs = np.where(xy[below] >= 0, 1.0, -1.0)
+    xy[below] = (1 - np.abs(xy[below][:, ::-1])) * signs
+    normals = np.column_stack([xy, z])
+    return normals / np.linalg.norm(normals, axis=1)[:, None]
+
+
+def delta_encode(indices):
+    '''Zigzag encoded differences of consecutive indices, small numbers
+    for the coherent index streams of a tessellation'''
+    deltas = np.diff(indices.ravel().astype(np.int64), prepend=0)
+    return ((deltas << 1) ^ (deltas >> 63)).astype('<u4')
+
+
+def delta_decode(encoded):
+    '''(M, 3) indices of delta_encode output'''
+    zigzag = encoded.astype(np.int64)
+    deltas = (zigzag >> 1) ^ -(zigzag & 1)
+    return np.cumsum(deltas).astype(np.int32).reshape(-1, 3)
+
+
+def quantization_grid(vertices, bits=QMZ_POSITION_BITS):
+    '''Origin and cell size of the grid of a mesh's bounding box'''
+    if len(vertices) == 0:
+        return np.zeros(3), np.ones(3)
+    lower = vertices.min(axis=0)
+    extent = vertices.max(axis=0) - lower
+    extent[extent == 0] = 1
+    return lower, extent / (2**bits - 1)
+
+
+def write_qmz(filename, meshes):
+    '''Writes (index, obj, mesh_arrays) items as a .qmz archive, see
+    QMZ_MAGIC. Positions are off by at most half a grid cell per axis,
+    the "error" bound of every mesh in the header'''
+    header = {"version": 1, "position_bits": QMZ_POSITION_BITS,
+              "normal_bits": QMZ_NORMAL_BITS, "meshes": []}
+    chunks = []
+    for objind, obj, arrays in meshes:
+        vertices, normals, triangles, normal_indices = arrays
+        lower, cell = quantization_grid(vertices)
+        positions = np.round((vertices - lower) / cell).astype('<u2')
+        header["meshes"].append({"name": obj.Label,
+                                 "vertices": len(vertices),
+                                 "normals": len(normals),
+                                 "triangles": len(triangles),
+                                 "lower": lower.tolist(),
+                                 "cell": cell.tolist(),
+                                 "error": float(np.linalg.norm(cell / 2))})
+        chunks.extend([positions, oct_encode(normals),
+                       delta_encode(triangles), delta_encode(normal_indices)])
+
+    data = json.dumps(header, separators=(',', ':')).encode()
+    with gzip.open(filename, 'wb') as qmz_file:
+        qmz_file.write(QMZ_MAGIC)
+        qmz_file.write(np.uint32(len(data)).astype('<u4').tobytes())
+        qmz_file.write(data)
+        for chunk in chunks:
+            qmz_file.write(np.ascontiguousarray(chunk).tobytes())
+    print("file %s successfully created\n" % filename)
+
+
+def read_qmz(filename):
+    '''Decodes a .qmz archive. Returns [(name, mesh_arrays, error)] with
+    error the bound on the position error of the mesh'''
+    with gzip.open(filename, 'rb') as qmz_file:
+        data = qmz_file.read()
+    if data[:4] != QMZ_MAGIC:
+        raise Exception('Not a qmz mesh archive: %s' % filename)
+    length = int(np.frombuffer(data, '<u4', 1, 4)[0])
+    header = json.loads(data[8:8 + length].decode())
+    if header["version"] != 1:
+        raise Exception('Unsupported qmz version %s' % header["version"])
+    offset = 8 + length
+
+    def take(dtype, count, width):
+        nonlocal offset
+        array = np.frombuffer(data, dtype, count * width, offset)
+        offset += array.nbytes
+        return array.reshape(-1, width) if width > 1 else array
+
+    decoded = []
+    for mesh in header["meshes"]:
+        positions = take('<u2', mesh["vertices"], 3)
+        normals = take('<i2', mesh["normals"], 2)
+        triangles = take('<u4', mesh["triangles"], 3)
+        normal_indices = take('<u4', mesh["triangles"], 3)
+        vertices = positions * np.array(mesh["cell"]) + np.array(mesh["lower"])
+        arrays = (vertices, oct_decode(normals, header["normal_bits"]),
+                  delta_decode(triangles), delta_decode(normal_indices))
+        decoded.append((mesh["name"], arrays, mesh["error"]))
+    return decoded
+
+
+def mesh_error(arrays, decoded):
+    '''Largest position distance and normal angle in degrees between two
+    mesh_arrays of the same topology, e.g. before and after read_qmz'''
+    if not np.array_equal(arrays[2], decoded[2]) or not np.array_equal(arrays[3], decoded[3]):
+        raise Exception('Mesh topology changed')
+    position = np.linalg.norm(arrays[0] - decoded[0], axis=1)
+    normals = arrays[1] / np.linalg.norm(arrays[1], axis=1)[:, None]
+    cosines = np.clip((normals * decoded[1]).sum(axis=1), -1, 1)
+    return {"position": float(position.max(initial=0)),
+            "normal": float(np.degrees(np.arccos(cosines)).max(initial=0))}
+
+
+def export_qmz(exportList, filename, scale=0.001, quality=1, offset=np.zeros(3),
+               per_face=False, cache=None, local=False, weld=None,
+               digests=None):
+    '''Compact .qmz archive exporter, arguments as for export_collada'''
+    write_qmz(filename, export_arrays(exportList, scale, quality, offset,
+                                      per_face, cache, local, weld, digests))
+
+
+# Mesh file extensions Gazebo loads and their exporters, .qmz archives
+# are written next to them with export_archive
+MESH_FORMATS = {'dae': export_collada,
+                'stl': export_stl,
+                'glb': export_glb}
+
+# Mesh file extensions and their writers of mesh_arrays
+MESH_WRITERS = {'dae': write_collada,
+                'stl': write_stl,
+                'glb': write_glb}
+
+
+def replace_file(filename, write):
+    '''Calls write with a temporary path next to filename and moves the
+    result into place, so that readers and concurrent exports never see
+    a partly written file'''
+    tmp = '%s.tmp%d' % (filename, os.getpid())
+    try:
+        write(tmp)
+        os.replace(tmp, filename)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def export_mesh(exportList, filename, mesh_format='dae', **kwargs):
+    '''Exports a mesh file in one of MESH_FORMATS, keyword arguments
+    are passed on to its exporter'''
+    if mesh_format not in MESH_FORMATS:
+        raise Exception('Invalid mesh format %s' % mesh_format)
+    replace_file(filename, lambda tmp: MESH_FORMATS[mesh_format](exportList, tmp, **kwargs))
+
+
+
+def export_archive(exportList, filename, **kwargs):
+    '''Exports a .qmz archive for storage and transfer, keyword arguments
+    are passed on to export_qmz'''
+    replace_file(filename, lambda tmp: export_qmz(exportList, tmp, **kwargs))
+
+###################################################################
+# Collision meshes
+###################################################################
+
+def compact(vertices, triangles):
+    '''Drops the vertices no triangle refers to and renumbers the triangles'''
+    used, inverse = np.unique(triangles, return_inverse=True)
+    return vertices[used], inverse.reshape(-1, 3).astype(np.int32)
+
+
+def unique_triangle_indices(triangles, winding=False):
+    '''Indices of the triangles that are not degenerate and not duplicates
+    of an earlier triangle in any vertex order, or with winding=True only
+    of one in the same winding, so that back to back triangles stay'''
+    t = triangles
+    keep = np.flatnonzero((t[:, 0] != t[:, 1]) & (t[:, 1] != t[:, 2])
+                          & (t[:, 0] != t[:, 2]))
+    t = t[keep]
+    if winding:
+        # rotated to start at the smallest index
+        order = (np.argmin(t, axis=1)[:, None] + np.arange(3)) % 3
+        t = np.take_along_axis(t, order, axis=1)
+    else:
+        t = np.sort(t, axis=1)
+    _, first = np.unique(t, axis=0, return_index=True)
+    return keep[np.sort(first)]
+
+
+def unique_triangles(triangles):
+    '''Drops degenerate triangles and duplicates of a triangle
+    in any vertex order, keeping the first occurrence'''
+    return triangles[unique_triangle_indices(triangles)]
+
+
+def cluster_vertices(vertices, triangles, cell):
+    '''Merges all vertices within a grid cell of the given size into their
+    centroid. Returns (vertices, triangles) without collapsed triangles'''
+    keys = np.floor((vertices - vertices.min(axis=0)) / cell).astype(np.int64)
+    keys, inverse = np.unique(keys, axis=0, return_inverse=True)
+    inverse = inverse.ravel()
+    counts = np.bincount(inverse, minlength=len(keys))
+    centroids = np.stack([np.bincount(inverse, vertices[:, i], len(keys))
+                          for i in range(3)], axis=1) / counts[:, None]
+    return compact(centroids, unique_triangles(inverse[triangles]))
+
+
+def decimate(vertices, triangles, max_triangles=1000):
+    '''Simplifies a mesh by vertex clustering, coarsening the grid until
+    at most max_triangles remain. Returns (vertices, triangles)'''
+    if len(triangles) <= max_triangles:
+        return vertices, triangles
+    diagonal = np.linalg.norm(vertices.max(axis=0) - vertices.min(axis=0))
+    cell = diagonal / np.sqrt(max_triangles)
+    while True:
+        clustered, clustered_triangles = cluster_vertices(vertices, triangles, cell)
+        if len(clustered_triangles) <= max_triangles:
+            return clustered, clustered_triangles
+        cell *= 1.25
+
+
+def convex_hull(vertices):
+    '''Convex hull of a mesh as outward oriented (vertices, triangles),
+    computed with scipy'''
+    try:
+        from scipy.spatial import ConvexHull
+    except ImportError:
+        raise Exception('Convex hull collision meshes require scipy')
+    hull = ConvexHull(vertices)
+    triangles = hull.simplices.astype(np.int32)
+    inward = (facet_normals(vertices, triangles) * hull.equations[:, :3]).sum(axis=1) < 0
+    triangles[inward] = triangles[inward][:, ::-1]
+    return compact(vertices, triangles)
+
+
+def collision_arrays(arrays, mode='decimate', max_triangles=1000):
+    '''Simplified collision geometry of mesh_arrays, mode "decimate" for
+    a mesh of at most max_triangles triangles or "hull" for its convex
+    hull. Returns mesh_arrays with facet normals'''
+    vertices, triangles = arrays[0], arrays[2]
+    if len(triangles) == 0:
+        return arrays
+    if mode == 'hull':
+        vertices, triangles = convex_hull(vertices[np.unique(triangles)])
+    elif mode == 'decimate':
+        vertices, triangles = decimate(vertices, triangles, max_triangles)
+    else:
+        raise Exception('Invalid collision mode %s' % mode)
+    normal_indices = np.repeat(np.arange(len(triangles), dtype=np.int32),
+                               3).reshape(-1, 3)
+    return vertices, facet_normals(vertices, triangles), triangles, normal_indices
+
+
+def export_collision(exportList, filename, mode='decimate', max_triangles=1000,
+                     mesh_format='stl', **kwargs):
+    '''Exports the collision_arrays of objects as a mesh file in one of
+    MESH_WRITERS, keyword arguments are passed on to export_arrays'''
+    meshes = ((objind, obj, collision_arrays(arrays, mode, max_triangles))
+              for objind, obj, arrays in export_arrays(exportList, **kwargs))
+    replace_file(filename, lambda tmp: MESH_WRITERS[mesh_format](tmp, meshes))
+
+
+###################################################################
+# Mesh cleanup
+###################################################################
+
+# the cell itself and half of its 26 neighbours, the other half is
+# covered from the neighbours
+NEIGHBOUR_CELLS = np.array([(0, 0, 0), (1, 0, 0), (0, 1, 0), (0, 0, 1),
+                            (1, 1, 0), (1, -1, 0), (1, 0, 1), (1, 0, -1),
+                            (0, 1, 1), (0, 1, -1), (1, 1, 1), (1, 1, -1),
+                            (1, -1, 1), (1, -1, -1)], dtype=np.int64)
+
+
+def cell_keys(cells):
+    '''Packs integer grid cells, at least 0, into single keys that sort
+    like the cells and shift with them, cell_keys(cells + offset) being
+    cell_keys(cells) + cell_keys(offset). Cells too far apart to pack
+    may share a key, which only costs a wasted distance check'''
+    return (cells[:, 0] << 42) + (cells[:, 1] << 21) + cells[:, 2]
+
+
+def close_pairs(points, tolerance):
+    '''Pairs (a, b) of indices of points at most tolerance apart, found
+    in the neighbouring cells of a grid of cell size tolerance'''
+    cells = np.floor(points / tolerance).astype(np.int64)
+    keys = cell_keys(cells - cells.min(axis=0))
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+    unique_keys, starts, counts = np.unique(keys, return_index=True,
+                                            return_counts=True)
+    pairs = []
+    for offset in cell_keys(NEIGHBOUR_CELLS):
+        # the neighbour keys come sorted, which keeps the search fast
+        found = np.searchsorted(unique_keys, keys + offset)
+        found[found == len(unique_keys)] = 0
+        hit = unique_keys[found] == keys + offset
+        a = np.flatnonzero(hit)
+        found_counts = counts[found[a]]
+        a = np.repeat(a, found_counts)
+        ends = np.cumsum(found_counts)
+        b = (np.repeat(starts[found[hit]] - ends + found_counts, found_counts)
+             + np.arange(len(a)))
+        close = ((points[order[a]] - points[order[b]])**2).sum(axis=1) <= tolerance**2
+        if not offset:
+            close &= a < b
+        pairs.append((order[a[close]], order[b[close]]))
+    return (np.concatenate([a for a, b in pairs]),
+            np.concatenate([b for a, b in pairs]))
+
+
+def weld_indices(points, tolerance):
+    '''Welds points at most tolerance apart, and through them chains of
+    such points. Returns (first, inverse): the index of the first point of
+    every weld and the weld of every point'''
+    # equal points are welded up front, so a cell only holds a few points
+    unique, inverse = np.unique(points, axis=0, return_inverse=True)
+    inverse = inverse.ravel()
+    a, b = close_pairs(unique, tolerance)
+    # every weld takes the smallest label of its points
+    labels = np.arange(len(unique))
+    while True:
+        previous = labels
+        lowest = np.minimum(labels[a], labels[b])
+        labels = labels.copy()
+        np.minimum.at(labels, a, lowest)
+        np.minimum.at(labels, b, lowest)
+        labels = labels[labels]
+        if np.array_equal(labels, previous):
+            break
+    _, inverse = np.unique(labels[inverse], return_inverse=True)
+    inverse = inverse.ravel()
+    _, first = np.unique(inverse, return_index=True)
+    return first, inverse
+
+
+def weld_arrays(arrays, tolerance=1e-6, normal_tolerance=1e-4):
+    '''Cleans up the tessellation of mesh_arrays: welds the vertices the
+    faces duplicate along their seams and equal normals, drops zero-area
+    and duplicate triangles and the vertices and normals left unused.
+    Normals keep their own indices, so welded seams stay sharp.
+    tolerance - welding distance, in the units of the vertices
+    normal_tolerance - welding distance of the unit normals
+    Returns (mesh_arrays, { "vertices": <saved>, "triangles": <saved> })'''
+    vertices, normals, triangles, normal_indices = arrays
+    if len(triangles) == 0:
+        return arrays, {"vertices": 0, "triangles": 0}
+    first, inverse = weld_indices(vertices, tolerance)
+    welded, welded_triangles = vertices[first], inverse[triangles]
+    first, inverse = weld_indices(normals, normal_tolerance)
+    welded_normals, welded_normal_indices = normals[first], inverse[normal_indices]
+
+    # twice the triangle areas, collapsed triangles have none
+    corners = welded[welded_triangles]
+    areas = np.linalg.norm(np.cross(corners[:, 1] - corners[:, 0],
+                                    corners[:, 2] - corners[:, 0]), axis=1)
+    keep = np.flatnonzero(areas > tolerance**2)
+    keep = keep[unique_triangle_indices(welded_triangles[keep], winding=True)]
+
+    welded, welded_triangles = compact(welded, welded_triangles[keep])
+    welded_normals, welded_normal_indices = compact(welded_normals,
+                                                    welded_normal_indices[keep])
+    saved = {"vertices": len(vertices) - len(welded),
+             "triangles": len(triangles) - len(welded_triangles)}
+    return (welded, welded_normals, welded_triangles, welded_normal_indices), saved
+
+
+###################################################################
+# Collision primitives
+###################################################################
+
+def detect_primitive(shape, tolerance=0.01):
+    '''Detects a shape, in its part frame, that is a box, cylinder or sphere
+    within a relative volume tolerance. Returns the primitive as
+    { "type": <type>, <dimensions>, "pose": <placement of its center> }
+    in the units of the shape, or None'''
+    volume = shape.Volume
+    if volume <= 0:
+        return None
+    faces = shape.Faces
+    surfaces = [f.Surface for f in faces]
+
+    def matches(primitive_volume):
+        return abs(primitive_volume - volume) <= tolerance * volume
+
+    if len(faces) == 1 and isinstance(surfaces[0], Part.Sphere):
+        radius = surfaces[0].Radius
+        if matches(4.0/3.0 * np.pi * radius**3):
+            return {"type": "sphere", "radius": radius,
+                    "pose": FreeCAD.Placement(surfaces[0].Center, FreeCAD.Rotation())}
+
+    cylinders = [s for s in surfaces if isinstance(s, Part.Cylinder)]
+    planes = [s for s in surfaces if isinstance(s, Part.Plane)]
+    if len(faces) == 3 and len(cylinders) == 1 and len(planes) == 2:
+        surface = cylinders[0]
+        axis = surface.Axis
+        heights = [(v.Point - surface.Center).dot(axis) for v in shape.Vertexes]
+        length = max(heights) - min(heights)
+        if matches(np.pi * surface.Radius**2 * length):
+            center = surface.Center + axis * ((max(heights) + min(heights)) / 2)
+            rotation = FreeCAD.Rotation(FreeCAD.Vector(0, 0, 1), axis)
+            return {"type": "cylinder", "radius": surface.Radius, "length": length,
+                    "pose": FreeCAD.Placement(center, rotation)}
+
+    bound_box = shape.BoundBox
+    if matches(bound_box.XLength * bound_box.YLength * bound_box.ZLength):
+        return {"type": "box",
+                "size": (bound_box.XLength, bound_box.YLength, bound_box.ZLength),
+                "pose": FreeCAD.Placement(bound_box.Center, FreeCAD.Rotation())}
+    return None
+
+
+def scale_primitive(primitive, scale):
+    '''Returns a copy of a detect_primitive result in scaled units'''
+    scaled = {}
+    for key, value in primitive.items():
+        if key == "type":
+            scaled[key] = value
+        elif key == "pose":
+            scaled[key] = FreeCAD.Placement(value.Base * scale, value.Rotation)
+        elif key == "size":
+            scaled[key] = tuple(v * scale for v in value)
+        else:
+            scaled[key] = value * scale
+    return scaled
+
+
+def primitive_to_xml(primitive, fmt='sdf'):
+    '''Converts a scaled primitive to a box, cylinder or sphere element'''
+    dimensions = [k for k in ('size', 'radius', 'length') if k in primitive]
+    elem = ET.Element(primitive["type"])
+    for key in dimensions:
+        value = primitive[key]
+        text = ' '.join(flt2str(v) for v in value) if key == 'size' else flt2str(value)
+        if fmt == 'urdf':
+            elem.set(key, text)
+        else:
+            ET.SubElement(elem, key).text = text
+    return elem
+
+
+###################################################################
+# Mass properties
+###################################################################
+
+def mass_properties(shape, backend='exact', quality=1):
+    '''Mass, center of mass and inertia tensor about the center of mass
+    of a shape of unit density, in the units and frame of the shape
+    backend - "exact" integrates the BREP with OCCT, "mesh" integrates its
+    tessellation at quality with mesh_mass_properties'''
+    if backend == 'mesh':
+        deflection = linear_deflection(shape, quality)
+        points, triangles = shape.tessellate(deflection)
+        return mesh_mass_properties(flat_array(points),
+                                    flat_array(triangles, dtype=np.int64), deflection)
+    inertia = np.array(shape.MatrixOfInertia.A).reshape(4, 4)[:3, :3]
+    return {"mass": shape.Mass,
+            "com": list(shape.CenterOfMass),
+            "inertia": inertia.tolist()}
+
+
+def mesh_mass_properties(vertices, triangles, deflection=0):
+    '''mass_properties of the solid bounded by a closed triangle mesh, by
+    the divergence theorem as a sum over the signed tetrahedra spanned by
+    the origin and each triangle. The tessellation stays within deflection
+    of the surface, so "error" bounds the relative error of the mass by
+    surface area * deflection / volume'''
+    a, b, c = (vertices[triangles[:, i]] for i in range(3))
+    # six times the signed volume of each tetrahedron
+    det = np.einsum('ij,ij->i', a, np.cross(b, c))
+    corners = np.stack((a, b, c, a + b + c), axis=1)
+    volume = det.sum() / 6
+    com = det @ corners[:, 3] / (24 * volume)
+    # second moments of the tetrahedra about the origin
+    covariance = np.einsum('i,ikj,ikl->jl', det, corners, corners) / 120
+    if volume < 0:
+        # inward oriented triangles
+        volume, covariance = -volume, -covariance
+    covariance -= volume * np.outer(com, com)
+    inertia = np.trace(covariance) * np.eye(3) - covariance
+    area = np.linalg.norm(np.cross(b - a, c - a), axis=1).sum() / 2
+    return {"mass": float(volume),
+            "com": com.tolist(),
+            "inertia": inertia.tolist(),
+            "error": float(area * deflection / volume)}
+
+
+class MassPropertyCache(object):
+    '''Cache of mass_properties by shape_hash. Entries are kept in memory
+    for the links of an export and as one json file per shape across runs'''
+    def __init__(self, directory=None):
+        self.directory = directory or cache_dir('mass_properties')
+        self.entries = {}
+        os.makedirs(self.directory, exist_ok=True)
+
+    def key(self, digest, backend='exact', quality=1):
+        if backend != 'exact':
+            return hashlib.sha1((digest + repr((backend, quality))).encode()).hexdigest()
+        return digest
+
+    def lookup(self, digest, backend='exact', quality=1):
+        '''Returns the cached mass_properties of a shape_hash or None'''
+        key = self.key(digest, backend, quality)
+        if key not in self.entries:
+            try:
+                with open(os.path.join(self.directory, key + '.json')) as entry:
+                    self.entries[key] = json.load(entry)
+            except (OSError, ValueError):
+                return None
+        return self.entries[key]
+
+    def get(self, shape, digest=None, backend='exact', quality=1):
+        '''Returns the mass_properties of a shape in its part frame
+        digest - shape_hash of the shape, computed if not given'''
+        if digest is None:
+            digest = shape_hash(shape)
+        properties = self.lookup(digest, backend, quality)
+        if properties is None:
+            key = self.key(digest, backend, quality)
+            properties = mass_properties(shape, backend, quality)
+            path = os.path.join(self.directory, key + '.json')
+            tmp = '%s.tmp%d' % (path, os.getpid())
+            with open(tmp, 'w') as entry:
+                json.dump(properties, entry)
+            os.replace(tmp, path)
+            self.entries[key] = properties
+        return properties
+
+
+def link_inertials(objects, configs={}, cache=None, digests={}):
+    '''Mass properties in SI units of a list of Part objects in their part
+    frames, computed once per unique shape
+    configs["density"] - density of the parts, 1000 by default
+    configs["densities"] - { label: density } overriding it for some parts
+    configs["inertia_backend"] - "exact" (default) or "mesh" to integrate
+    the part_quality tessellation instead, see mesh_mass_properties
+    configs["principal_inertia"] - diagonalize the inertia tensors, their
+    "rotation" turns the part frame into the principal axes
+    digests - { label: shape_hash } of the parts in their part frames
+    returns { label: { "mass": <float>, "com": <Vector>, "inertia": <3x3 array>,
+                       "rotation": <Rotation> } }'''
+    scale = configs.get('scale', 0.001)
+    density = configs.get('density', 1000)
+    densities = configs.get('densities', {})
+    backend = configs.get('inertia_backend', 'exact')
+    if cache is None:
+        cache = MassPropertyCache()
+    inertials = {}
+    for obj in objects:
+        # the part is only copied when its mass properties are computed
+        digest = digests.get(obj.Label)
+        shape = None
+        quality = None
+        if backend == 'mesh':
+            shape = part_shape(obj, local=True)
+            quality = part_quality(shape, configs)
+        properties = cache.lookup(digest, backend, quality) if digest else None
+        if properties is None:
+            properties = cache.get(shape or part_shape(obj, local=True), digest,
+                                   backend, quality)
+        part_density = densities.get(obj.Label, density)
+        inertia = np.array(properties["inertia"]) * scale**5 * part_density
+        rotation = FreeCAD.Rotation()
+        if configs.get('principal_inertia'):
+            moments, rotation = principal_inertia(inertia)
+            if not valid_inertia(moments):
+                raise Exception('Inertia of %s is not physically valid: %s'
+                                % (obj.Label, moments))
+            inertia = np.diag(moments)
+        inertials[obj.Label] = {
+            "mass": properties["mass"] * scale**3 * part_density,
+            "com": FreeCAD.Vector(*properties["com"]) * scale,
+            "inertia": inertia,
+            "rotation": rotation}
+    return inertials
+
+
+def principal_inertia(inertia):
+    '''Diagonalizes a symmetric inertia tensor, returns the principal
+    moments and the Rotation whose axes are the principal axes'''
+    moments, axes = np.linalg.eigh(inertia)
+    if np.linalg.det(axes) < 0:
+        # eigh may return a left handed basis
+        axes[:, 2] = -axes[:, 2]
+    matrix = np.identity(4)
+    matrix[:3, :3] = axes
+    return moments, FreeCAD.Rotation(FreeCAD.Matrix(*matrix.ravel()))
+
+
+def valid_inertia(moments, tolerance=1e-6):
+    '''True if principal moments are positive and each is at most the
+    sum of the other two, up to a relative tolerance'''
+    moments = np.sort(moments)
+    return bool(moments[0] > 0 and
+                moments[2] <= (moments[0] + moments[1]) * (1 + tolerance))
+
+
+def inertia_elements(tensor):
+    '''ixx, ixy, ixz, iyy, iyz, izz of a 3x3 inertia tensor'''
+    return np.asarray(tensor)[np.triu_indices(3)]
+
+
 ###################################################################
 # Conversion Helpers
 ###################################################################
@@ -172,10 +1564,12 @@ def flt2str(f):
 ###################################################################
 
 def add_poses(p1, p2):
-    return FreeCAD.Placement(p1.toMatrix() + p2.toMatrix())
+    '''Composes pose p2, given relative to p1, onto p1'''
+    return p1.multiply(p2)
 
 def subtract_poses(p1, p2):
-    return FreeCAD.Placement(p1.toMatrix() + p2.toMatrix().inverse())
+    '''Returns pose p1 relative to pose p2'''
+    return p2.inverse().multiply(p1)
 
 def pose_to_xml(pose, fmt='sdf'):
     '''Converts a pose/freecad placement/ to xml element
@@ -199,6 +1593,47 @@ def pose_xyz(pose):
     xyz = pose.Base if hasattr(pose, 'Base') else pose
     return ' '.join([flt2str(i) for i in xyz])
 
+QUOTE = {'"': '&quot;'}
+
+
+def xml_attributes(attributes):
+    '''Formats attributes the way minidom does, double quoted'''
+    return ''.join(' %s="%s"' % (k, escape(str(v), QUOTE)) for k, v in attributes.items())
+
+
+def write_xml_start(out, tag, attributes={}, indent=None, level=0):
+    '''Writes the start tag of an element on its own line, indented by
+    level times indent, or without line breaks if indent is None'''
+    pad, newline = ('', '') if indent is None else (indent*level, '\n')
+    attrs = xml_attributes(attributes)
+    out.write('%s<%s%s>%s' % (pad, tag, attrs, newline))
+
+
+def write_xml_end(out, tag, indent=None, level=0):
+    '''Writes the end tag matching write_xml_start'''
+    pad, newline = ('', '') if indent is None else (indent*level, '\n')
+    out.write('%s</%s>%s' % (pad, tag, newline))
+
+
+def write_xml(elem, out, indent=None, level=0):
+    '''Writes an element and its children to a file handle in one pass,
+    text-only and empty elements on a single line'''
+    children = list(elem)
+    if children:
+        write_xml_start(out, elem.tag, elem.attrib, indent, level)
+        for child in children:
+            write_xml(child, out, indent, level + 1)
+        write_xml_end(out, elem.tag, indent, level)
+        return
+    pad, newline = ('', '') if indent is None else (indent*level, '\n')
+    attrs = xml_attributes(elem.attrib)
+    if elem.text:
+        out.write('%s<%s%s>%s</%s>%s' % (pad, elem.tag, attrs, escape(elem.text, QUOTE),
+                                         elem.tag, newline))
+    else:
+        out.write('%s<%s%s/>%s' % (pad, elem.tag, attrs, newline))
+
+
 def config(model_name, sdf, author, email, desc, version):
     top = ET.Element('model')
     name = ET.SubElement(top, 'name')
@@ -218,8 +1653,10 @@ def config(model_name, sdf, author, email, desc, version):
     description = ET.SubElement(top, 'description')
     description.text = desc
 
-    dom = parseString(ET.tostring(top, encoding="unicode"))
-    return dom.toprettyxml(indent=' '*2)
+    out = io.StringIO()
+    out.write('<?xml version="1.0" ?>\n')
+    write_xml(top, out, indent=' '*2)
+    return out.getvalue()
 
 
 class SpatialEntity(object):
@@ -290,31 +1727,34 @@ class Model(SpatialEntity):
         for joint in self.joints:
             joint.global_pose = add_poses(joint.child_link.global_pose, joint.pose)
 
-    def to_xml(self, fmt='sdf'):
-        '''returns xml element of a model/robot'''
+    def root_attributes(self, fmt='sdf'):
+        '''returns the tag and attributes of the model/robot element'''
+        if fmt == 'urdf':
+            return 'robot', {'name': self.name, 'static': str(self.static).lower()}
+        return 'model', {'name': self.name}
+
+    def xml_children(self, fmt='sdf'):
+        '''yields the child elements of the model/robot one at a time'''
         super(Model, self).to_xml(fmt)
 
         self.build_tree()
         self.calculate_global_poses()
 
-        tag = 'robot' if fmt=='urdf' else 'model'
-        model = ET.Element(tag, name=self.name)
-
         if fmt == 'sdf':
-            model.append(pose_to_xml(self.pose))
-            static = ET.SubElement(model, 'static')
+            yield pose_to_xml(self.pose)
+            static = ET.Element('static')
             static.text = str(self.static).lower()
-            self_collide = ET.SubElement(model, 'self_collide')
+            yield static
+            self_collide = ET.Element('self_collide')
             self_collide.text = str(self.self_collide).lower()
+            yield self_collide
         else:
-            model.set('static', str(self.static).lower())
-
             root_link = self.get_root_link()
             if not root_link:
                 raise Exception("Couldn't find root link")
-            model.append(ET.Element('link', name=root_link.name+'_root'))
+            yield ET.Element('link', name=root_link.name+'_root')
         for link in self.links:
-            model.append(link.to_xml(fmt))
+            yield link.to_xml(fmt)
 
         if fmt=='urdf':
             root_joint = ET.Element('joint',
@@ -323,10 +1763,16 @@ class Model(SpatialEntity):
             root_joint.append(pose_to_xml(root_link.global_pose, fmt))
             ET.SubElement(root_joint, 'parent', link= root_link.name+'_root')
             ET.SubElement(root_joint, 'child', link= root_link.name)
-            model.append(root_joint)
+            yield root_joint
 
         for joint in self.joints:
-            model.append(joint.to_xml(fmt))
+            yield joint.to_xml(fmt)
+
+    def to_xml(self, fmt='sdf'):
+        '''returns xml element of a model/robot'''
+        tag, attributes = self.root_attributes(fmt)
+        model = ET.Element(tag, attributes)
+        model.extend(self.xml_children(fmt))
 
         if fmt == 'sdf':
             sdf = ET.Element('sdf', version=str(self.sdf_version))
@@ -335,9 +1781,27 @@ class Model(SpatialEntity):
 
         return model
 
-    def to_xml_string(self, fmt='sdf', header=True):
-        dom = parseString(ET.tostring(self.to_xml(fmt)))
-        return dom.toprettyxml(indent=' '*2)
+    def write(self, out, fmt='sdf', pretty=True):
+        '''streams the model/robot to a file handle in one pass, holding
+        only one link or joint element at a time, indented if pretty'''
+        indent = ' '*2 if pretty else None
+        out.write('<?xml version="1.0" ?>' + ('\n' if pretty else ''))
+        level = 0
+        if fmt == 'sdf':
+            write_xml_start(out, 'sdf', {'version': str(self.sdf_version)}, indent)
+            level = 1
+        tag, attributes = self.root_attributes(fmt)
+        write_xml_start(out, tag, attributes, indent, level)
+        for child in self.xml_children(fmt):
+            write_xml(child, out, indent, level + 1)
+        write_xml_end(out, tag, indent, level)
+        if fmt == 'sdf':
+            write_xml_end(out, 'sdf', indent)
+
+    def to_xml_string(self, fmt='sdf', header=True, pretty=True):
+        out = io.StringIO()
+        self.write(out, fmt, pretty)
+        return out.getvalue()
 
 
 class Inertia(object):
@@ -394,6 +1858,7 @@ class Geom(SpatialEntity):
     def __init__(self, **kwargs):
         super(Geom, self).__init__(**kwargs)
         self.mesh = kwargs.get('mesh', '')
+        self.primitive = kwargs.get('primitive', None)
         self.type = kwargs.get('type', 'visual')
 
     def to_xml(self, fmt='sdf'):
@@ -403,6 +1868,9 @@ class Geom(SpatialEntity):
         pose = self.pose if fmt=='sdf' else self.urdf_pose
         elem.append(pose_to_xml(pose, fmt=fmt))
         geom = ET.SubElement(elem, 'geometry')
+        if self.primitive:
+            geom.append(primitive_to_xml(self.primitive, fmt))
+            return elem
         mesh = ET.SubElement(geom, 'mesh')
         if fmt=='urdf':
             mesh.set('filename', 'package://' + self.mesh)
@@ -441,7 +1909,7 @@ class Link(SpatialEntity):
         self.visuals.extend(kwargs.get('visuals', []))
 
         if 'collision' in kwargs:
-            self.visuals.append(kwargs.get('collision', Collision()))
+            self.collisions.append(kwargs.get('collision', Collision()))
         self.collisions.extend(kwargs.get('collisions', []))
 
     def to_xml(self, fmt='sdf'):
@@ -458,14 +1926,14 @@ class Link(SpatialEntity):
         if fmt == 'sdf':
             link.append(pose_to_xml(self.pose, fmt=fmt))
 
-        self.inertial.urdf_pose = add_poses(self.inertial.pose, self.urdf_pose)
+        self.inertial.urdf_pose = add_poses(self.urdf_pose, self.inertial.pose)
         link.append(self.inertial.to_xml(fmt=fmt))
 
         for visual in self.visuals:
-            visual.urdf_pose = self.urdf_pose.copy()
+            visual.urdf_pose = self.urdf_pose.multiply(visual.pose)
             link.append(visual.to_xml(fmt=fmt))
         for collision in self.collisions:
-            collision.urdf_pose = self.urdf_pose.copy()
+            collision.urdf_pose = self.urdf_pose.multiply(collision.pose)
             link.append(collision.to_xml(fmt=fmt))
 
         return link
@@ -0,0 +1,116 @@
+# Compares the legacy list-based mesh assembly of export_collada with the
+# vectorized GazeboExport.mesh_arrays path on a finely tessellated shape,
+# and with --synthetic on tessellate()-shaped input of 4000 faces with
+# 500 triangles each (2M triangles), which isolates the assembly from the
+# meshing. Both paths must produce the same arrays.
+# Run with: FreeCADCmd benchmarks/bench_mesh_assembly.py [--synthetic]
+import os, sys, time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import FreeCAD, Part
+import numpy as np
+import GazeboExport
+
+
+def legacy_assembly(obj, scale=0.001, quality=1, offset=np.zeros(3)):
+    m = obj.Shape.tessellate(quality)
+    vindex = []
+    nindex = []
+    findex = []
+    for v in m[0]:
+        vindex.extend([a*scale+b for a, b in zip(v, offset)])
+    for f in obj.Shape.Faces:
+        n = f.normalAt(0,0)
+        for i in range(len(f.tessellate(quality)[1])):
+            nindex.extend([n.x,n.y,n.z])
+    for i in range(len(m[1])):
+        f = m[1][i]
+        findex.extend([f[0],i,f[1],i,f[2],i])
+    return np.array(vindex), np.array(nindex), np.array(findex)
+
+
+def vectorized_assembly(obj, scale=0.001, quality=1, offset=np.zeros(3)):
+    vertices, normals, triangles, normal_indices = GazeboExport.mesh_arrays(
+        obj, scale, quality, offset)
+    return (vertices.ravel(), normals.ravel(),
+            GazeboExport.triangle_set_indices(triangles, normal_indices))
+
+
+class SyntheticFace(object):
+    def __init__(self, points, triangles, normal):
+        self.points = points
+        self.triangles = triangles
+        self.normal = normal
+
+    def tessellate(self, quality):
+        return self.points, self.triangles
+
+    def normalAt(self, u, v):
+        return self.normal
+
+
+class SyntheticShape(object):
+    '''Faces of random triangle strips, with the lists of Vectors and
+    index tuples that Shape.tessellate returns'''
+    def __init__(self, faces=4000, triangles=500, seed=0):
+        rng = np.random.default_rng(seed)
+        self.Faces = []
+        self.points = []
+        self.triangles = []
+        for i in range(faces):
+            points = [FreeCAD.Vector(*p) for p in rng.random((triangles + 2, 3))]
+            strip = [(j, j + 1, j + 2) for j in range(triangles)]
+            self.Faces.append(SyntheticFace(points, strip,
+                                            FreeCAD.Vector(*rng.random(3))))
+            offset = len(self.points)
+            self.points += points
+            self.triangles += [(a + offset, b + offset, c + offset) for a, b, c in strip]
+
+    def tessellate(self, quality):
+        return self.points, self.triangles
+
+    def copy(self, *args):
+        return self
+
+
+class SyntheticObject(object):
+    Label = Name = "synthetic"
+
+    def __init__(self, shape):
+        self.Shape = shape
+
+    def isDerivedFrom(self, type_name):
+        return type_name == "Part::Feature"
+
+
+def compare(obj, quality):
+    results = []
+    for func in (legacy_assembly, vectorized_assembly):
+        # tessellation is cached on the shape after the first call
+        start = time.perf_counter()
+        results.append(func(obj, quality=quality))
+        print("%-20s %.3f s" % (func.__name__, time.perf_counter() - start))
+    print("identical arrays: %s" % all(np.array_equal(a, b)
+                                       for a, b in zip(*results)))
+
+
+def synthetic():
+    obj = SyntheticObject(SyntheticShape())
+    print("triangles: %d" % len(obj.Shape.triangles))
+    compare(obj, 1)
+
+
+def main(quality=0.05):
+    doc = FreeCAD.newDocument("bench_mesh_assembly")
+    shape = Part.makeTorus(100, 30).fuse(Part.makeSphere(60))
+    obj = doc.addObject("Part::Feature", "bench")
+    obj.Shape = shape
+    print("triangles: %d" % len(shape.tessellate(quality)[1]))
+    compare(obj, quality)
+    FreeCAD.closeDocument(doc.Name)
+
+
+if "--synthetic" in sys.argv:
+    synthetic()
+else:
+    main()
@@ -0,0 +1,55 @@
+# Round trip of the compact .qmz mesh archive on test shapes: file sizes
+# against the other mesh formats, and the largest position and normal
+# errors after decoding, which must stay within the bound of the grid.
+# Run with: FreeCADCmd benchmarks/bench_mesh_encoding.py
+import os, sys, tempfile
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import FreeCAD, Part
+import numpy as np
+import GazeboExport
+
+
+def test_parts(doc):
+    shapes = {"box": Part.makeBox(40, 30, 20),
+              "cylinder": Part.makeCylinder(10, 50),
+              "sphere": Part.makeSphere(25),
+              "torus": Part.makeTorus(100, 30).fuse(Part.makeSphere(60))}
+    parts = []
+    for name, shape in shapes.items():
+        obj = doc.addObject("Part::Feature", name)
+        obj.Shape = shape
+        parts.append(obj)
+    return parts
+
+
+def main(quality=0.1):
+    doc = FreeCAD.newDocument("BenchMeshEncoding")
+    directory = tempfile.mkdtemp()
+    print("%-9s %9s %9s %9s %9s %10s %10s %9s" % ("part", "dae kB", "glb kB",
+          "stl kB", "qmz kB", "pos err", "bound", "nrm deg"))
+    ok = True
+    for obj in test_parts(doc):
+        sizes = []
+        for mesh_format in ('dae', 'glb', 'stl', 'qmz'):
+            filename = os.path.join(directory, obj.Label + '.' + mesh_format)
+            if mesh_format == 'qmz':
+                GazeboExport.export_archive([obj], filename, quality=quality,
+                                            per_face=True, weld=1e-6)
+            else:
+                GazeboExport.export_mesh([obj], filename, mesh_format, quality=quality,
+                                         per_face=True, weld=1e-6)
+            sizes.append(os.path.getsize(filename) / 1024.)
+        arrays = next(GazeboExport.export_arrays([obj], quality=quality,
+                                                 per_face=True, weld=1e-6))[2]
+        name, decoded, bound = GazeboExport.read_qmz(filename)[0]
+        error = GazeboExport.mesh_error(arrays, decoded)
+        ok = ok and error["position"] <= bound
+        print("%-9s %9.1f %9.1f %9.1f %9.1f %10.2e %10.2e %9.4f" % (
+            (obj.Label,) + tuple(sizes) + (error["position"], bound, error["normal"])))
+    FreeCAD.closeDocument(doc.Name)
+    print("round trip within bound" if ok else "ROUND TRIP ERROR EXCEEDS BOUND")
+    return ok
+
+
+sys.exit(0 if main() else 1)
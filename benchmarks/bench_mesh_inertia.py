@@ -0,0 +1,50 @@
+# Compares the mesh based inertia backend of GazeboExport.mass_properties
+# with the exact OCCT integration on test shapes: run time, the relative
+# error of mass and inertia tensor, the center of mass offset relative to
+# the bounding box diagonal and the reported bound on the mass error.
+# Run with: FreeCADCmd benchmarks/bench_mesh_inertia.py
+import os, sys, time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import FreeCAD, Part
+import numpy as np
+import GazeboExport
+
+
+def test_shapes():
+    V = FreeCAD.Vector
+    wave = Part.BSplineSurface()
+    wave.interpolate([[V(x*10, y*10, 5*np.sin(x+y)) for y in range(8)] for x in range(8)])
+    return {"box": Part.makeBox(40, 30, 20),
+            "cylinder": Part.makeCylinder(10, 50),
+            "sphere": Part.makeSphere(25),
+            "torus": Part.makeTorus(100, 30).fuse(Part.makeSphere(60)),
+            "bspline": wave.toShape().extrude(V(0, 0, 20))}
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def main(qualities=(1, 0.1, 0.01)):
+    print("%-9s %7s %9s %9s %9s %9s %9s %9s" % ("shape", "quality", "exact s",
+          "mesh s", "mass err", "com err", "inr err", "bound"))
+    for name, shape in test_shapes().items():
+        exact, exact_time = timed(GazeboExport.mass_properties, shape.copy())
+        for quality in qualities:
+            # fresh copies so neither backend reuses a triangulation
+            mesh, mesh_time = timed(GazeboExport.mass_properties, shape.copy(),
+                                    'mesh', quality)
+            inertia = np.array(exact["inertia"])
+            print("%-9s %7g %9.4f %9.4f %9.2e %9.2e %9.2e %9.2e" % (
+                name, quality, exact_time, mesh_time,
+                abs(mesh["mass"] - exact["mass"]) / exact["mass"],
+                np.linalg.norm(np.subtract(mesh["com"], exact["com"]))
+                    / shape.BoundBox.DiagonalLength,
+                np.linalg.norm(np.array(mesh["inertia"]) - inertia) / np.linalg.norm(inertia),
+                mesh["error"]))
+
+
+main()
@@ -0,0 +1,52 @@
+# Measures the import time of the workbench modules, each in a fresh
+# interpreter with FreeCAD already loaded, and lists the heavy
+# dependencies every import pulls in. ARFrames is what the workbench
+# imports on activation, so none of them should show up for it.
+# Run with: FreeCADCmd benchmarks/bench_startup.py
+import os, sys, json, subprocess
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ExportPool
+
+MODULES = ("ARFrames", "ARTools", "GraspPose", "GazeboExport", "ExportPool")
+HEAVY = ("numpy", "collada", "yaml", "scipy", "MeshPart", "PySide")
+
+PROBE = '''
+import sys, time, json
+import FreeCAD
+start = time.perf_counter()
+error = None
+try:
+    import %s
+except Exception as e:
+    error = repr(e)
+print(json.dumps({"seconds": time.perf_counter() - start, "error": error,
+                  "heavy": [m for m in %r if m in sys.modules]}))
+'''
+
+
+def import_time(module, python, repeat=5):
+    '''Best of repeat import times of a module in fresh interpreters'''
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    best = None
+    for i in range(repeat):
+        output = subprocess.check_output([python, "-c", PROBE % (module, HEAVY)],
+                                         env=env, universal_newlines=True)
+        result = json.loads(output.strip().splitlines()[-1])
+        if best is None or result["seconds"] < best["seconds"]:
+            best = result
+    return best
+
+
+def main():
+    python = ExportPool.worker_python()
+    for module in MODULES:
+        result = import_time(module, python)
+        if result["error"]:
+            print("%-14s failed: %s" % (module, result["error"]))
+            continue
+        print("%-14s %8.1f ms  loads: %s" % (module, result["seconds"] * 1000,
+                                           ", ".join(result["heavy"]) or "-"))
+
+
+main()
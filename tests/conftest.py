@@ -0,0 +1,13 @@
+import os
+import sys
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# The numpy parts of the exporters are tested without FreeCAD, against
+# empty stand-ins for the modules they import.
+for name in ("FreeCAD", "Part"):
+    try:
+        __import__(name)
+    except ImportError:
+        sys.modules[name] = types.ModuleType(name)
@@ -0,0 +1,35 @@
+import os
+
+# BatchExport is imported in the tests only, the spawned workers import
+# this module for fake_export and have no stand-in FreeCAD.
+
+
+def fake_export(path, target, configs={}):
+    if path.endswith("crash"):
+        # a worker dying like a crashing FreeCAD on a bad STEP file
+        os._exit(1)
+    return {"status": "done", "error": None, "seconds": 0.0}
+
+
+def export(paths, workers=2):
+    import BatchExport
+    targets = {path: "/tmp/out/" + path for path in paths}
+    return dict(BatchExport.export_files(paths, targets, workers=workers,
+                                         job=fake_export))
+
+
+def test_every_file_gets_a_record():
+    paths = ["a.FCStd", "b.step", "c.stp", "d.FCStd", "e.FCStd"]
+    records = export(paths)
+    assert sorted(records) == sorted(paths)
+    assert all(record["status"] == "done" for record in records.values())
+
+
+def test_files_pending_behind_a_crash_still_run():
+    paths = ["a.crash", "b.FCStd", "c.FCStd", "d.FCStd", "e.FCStd", "f.crash", "g.step"]
+    records = export(paths)
+    assert sorted(records) == sorted(paths)
+    failed = sorted(path for path, record in records.items()
+                    if record["status"] == "failed")
+    assert failed == ["a.crash", "f.crash"]
+    assert "BrokenProcessPool" in records["a.crash"]["error"]
@@ -0,0 +1,73 @@
+import os
+import sys
+import asyncio
+import multiprocessing
+import concurrent.futures
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ExportService
+
+# Drives ExportService over a Unix socket with a stand-in job in plain
+# worker processes, so it runs without FreeCAD.
+
+
+def fake_export(path, output, configs={}):
+    if path.endswith("crash"):
+        # a worker dying like a crashing FreeCAD
+        os._exit(1)
+    if path.endswith("raise"):
+        raise ValueError("bad file")
+    return {"status": "done", "error": None, "seconds": 0.0,
+            "packages": configs.get("packages", 1)}
+
+
+def make_pool(workers):
+    return concurrent.futures.ProcessPoolExecutor(
+        workers, mp_context=multiprocessing.get_context("spawn"))
+
+
+async def exchange(socket_path, paths, configs={}):
+    '''Runs a service, submits paths to it and returns their events and
+    the status of the service after they finished'''
+    service = ExportService.ExportService(2, queue_size=2, job=fake_export,
+                                          make_pool=make_pool)
+    server = await service.serve(socket_path)
+    try:
+        events = [event async for event in
+                  ExportService.submit(paths, "/tmp/out", configs, socket_path)]
+        status = await ExportService.query_status(socket_path)
+    finally:
+        server.close()
+        service.stop()
+    return events, status
+
+
+def test_jobs_stream_their_events(tmp_path):
+    socket_path = str(tmp_path / "service.sock")
+    paths = ["a.FCStd", "b.step", "c.raise", "d.FCStd"]
+    events, status = asyncio.run(exchange(socket_path, paths, {"packages": 3}))
+
+    by_id = {}
+    for event in events:
+        by_id.setdefault(event["id"], []).append(event["event"])
+    assert sorted(by_id) == [0, 1, 2, 3]
+    for job_id, kinds in by_id.items():
+        assert kinds[0] == "queued" and kinds[1] == "started"
+        assert kinds[2] == ("failed" if job_id == 2 else "done")
+    done = [event for event in events if event["event"] == "done"]
+    assert all(event["packages"] == 3 for event in done)
+    assert "bad file" in [e for e in events if e["event"] == "failed"][0]["error"]
+    assert status["finished"] == 4 and status["queued"] == 0
+    assert status["restarts"] == 0
+
+
+def test_service_recovers_from_a_crashed_worker(tmp_path):
+    socket_path = str(tmp_path / "service.sock")
+    paths = ["a.crash", "b.FCStd", "c.FCStd"]
+    events, status = asyncio.run(exchange(socket_path, paths))
+
+    results = {event["id"]: event["event"] for event in events
+               if event["event"] in ("done", "failed")}
+    assert results == {0: "failed", 1: "done", 2: "done"}
+    assert status["restarts"] >= 1
@@ -0,0 +1,73 @@
+import gzip
+import types
+
+import numpy as np
+import pytest
+
+import GazeboExport
+
+
+def sphere_arrays(radius=25.0, segments=24):
+    '''A UV sphere as mesh_arrays with vertex normals, pointing every way'''
+    theta, phi = np.meshgrid(np.linspace(0, np.pi, segments),
+                             np.linspace(0, 2 * np.pi, segments), indexing='ij')
+    normals = np.stack([np.sin(theta) * np.cos(phi), np.sin(theta) * np.sin(phi),
+                        np.cos(theta)], axis=-1).reshape(-1, 3)
+    grid = np.arange(segments * segments).reshape(segments, segments)
+    quads = np.stack([grid[:-1, :-1], grid[1:, :-1], grid[1:, 1:], grid[:-1, 1:]],
+                     axis=-1).reshape(-1, 4)
+    triangles = np.vstack([quads[:, [0, 1, 2]], quads[:, [0, 2, 3]]]).astype(np.int32)
+    return radius * normals + [100, -50, 3], normals, triangles, triangles.copy()
+
+
+def meshes(*labelled_arrays):
+    return [(index, types.SimpleNamespace(Label=label), arrays)
+            for index, (label, arrays) in enumerate(labelled_arrays)]
+
+
+def test_qmz_round_trip_is_within_its_bound(tmp_path):
+    filename = str(tmp_path / "parts.qmz")
+    sphere = sphere_arrays()
+    flat = sphere_arrays(radius=1.0)
+    flat[0][:, 2] = 0
+    GazeboExport.write_qmz(filename, meshes(("sphere", sphere), ("flat", flat)))
+
+    decoded = GazeboExport.read_qmz(filename)
+    assert [name for name, arrays, bound in decoded] == ["sphere", "flat"]
+    for original, (name, arrays, bound) in zip((sphere, flat), decoded):
+        error = GazeboExport.mesh_error(original, arrays)
+        assert error["position"] <= bound
+        assert error["normal"] < 0.01
+    # half a cell of the 16 bit grid of the bounding box
+    extent = sphere[0].max(axis=0) - sphere[0].min(axis=0)
+    assert decoded[0][2] == pytest.approx(np.linalg.norm(extent / (2**16 - 1) / 2))
+
+
+def test_qmz_keeps_empty_meshes(tmp_path):
+    filename = str(tmp_path / "empty.qmz")
+    empty = (np.zeros((0, 3)), np.zeros((0, 3)), np.zeros((0, 3), np.int32),
+             np.zeros((0, 3), np.int32))
+    GazeboExport.write_qmz(filename, meshes(("empty", empty)))
+    name, arrays, bound = GazeboExport.read_qmz(filename)[0]
+    assert name == "empty" and all(len(array) == 0 for array in arrays)
+
+
+def test_read_qmz_rejects_other_files(tmp_path):
+    filename = str(tmp_path / "mesh.qmz")
+    with gzip.open(filename, 'wb') as qmz_file:
+        qmz_file.write(b'solid mesh')
+    with pytest.raises(Exception, match="Not a qmz"):
+        GazeboExport.read_qmz(filename)
+
+
+def test_mesh_error_needs_the_same_topology():
+    arrays = sphere_arrays()
+    flipped = arrays[:2] + (arrays[2][:, ::-1], arrays[3])
+    with pytest.raises(Exception, match="topology"):
+        GazeboExport.mesh_error(arrays, flipped)
+    assert GazeboExport.mesh_error(arrays, arrays)["position"] == 0
+
+
+def test_archives_are_not_model_meshes():
+    assert 'qmz' not in GazeboExport.MESH_FORMATS
+    assert 'qmz' not in GazeboExport.MESH_WRITERS
@@ -0,0 +1,73 @@
+import numpy as np
+
+import GazeboExport
+
+
+def quad_arrays(seam_offset=0.0):
+    '''A unit square as two faces of one triangle each, every face with
+    its own copy of the two seam vertices'''
+    vertices = np.array([[0, 0, 0], [1, 0, 0], [1, 1, 0],
+                         [0, 0, 0], [1, 1, 0], [0, 1, 0]], dtype=float)
+    vertices[3:5] += seam_offset
+    normals = np.array([[0, 0, 1], [0, 0, 1]], dtype=float)
+    triangles = np.array([[0, 1, 2], [3, 4, 5]], dtype=np.int32)
+    normal_indices = np.array([[0, 0, 0], [1, 1, 1]], dtype=np.int32)
+    return vertices, normals, triangles, normal_indices
+
+
+def test_weld_saves_the_seam_vertices():
+    arrays, saved = GazeboExport.weld_arrays(quad_arrays(), 1e-6)
+    vertices, normals, triangles, normal_indices = arrays
+    assert saved == {"vertices": 2, "triangles": 0}
+    assert len(vertices) == 4 and len(normals) == 1
+    assert np.array_equal(vertices[triangles], quad_arrays()[0].reshape(2, 3, 3))
+
+
+def test_weld_across_a_cell_edge():
+    # 0.5e-6 lies on the edge of the rounding buckets of a 1e-6 tolerance
+    points = np.array([[0.5e-6 - 1e-12, 0, 0], [0.5e-6 + 1e-12, 0, 0],
+                       [1e-6 - 1e-12, 1e-6 - 1e-12, 0], [1e-6 + 1e-12, 1e-6 + 1e-12, 0]])
+    first, inverse = GazeboExport.weld_indices(points, 1e-6)
+    assert np.array_equal(inverse, [0, 0, 1, 1])
+    assert np.array_equal(first, [0, 2])
+
+
+def test_weld_keeps_points_further_apart():
+    points = np.array([[0, 0, 0], [2e-6, 0, 0], [0, 0, 1.5e-6]])
+    first, inverse = GazeboExport.weld_indices(points, 1e-6)
+    assert len(first) == 3 and len(set(inverse)) == 3
+
+
+def test_weld_chains_close_points():
+    points = np.array([[0, 0, 0], [0.8e-6, 0, 0], [1.6e-6, 0, 0]])
+    first, inverse = GazeboExport.weld_indices(points, 1e-6)
+    assert np.array_equal(first, [0]) and np.array_equal(inverse, [0, 0, 0])
+
+
+def test_weld_drops_duplicate_and_degenerate_triangles():
+    vertices, normals, triangles, normal_indices = quad_arrays(seam_offset=1e-9)
+    # the first face again, back to back with itself, a duplicate in
+    # another vertex order and a sliver collapsing into the seam
+    vertices = np.vstack([vertices, [[0.5, 0.5, 0]]])
+    triangles = np.vstack([triangles, [[0, 2, 1], [1, 2, 0], [0, 6, 4]]])
+    normal_indices = np.vstack([normal_indices, [[0, 0, 0]] * 3])
+    arrays, saved = GazeboExport.weld_arrays(
+        (vertices, normals, triangles, normal_indices), 1e-6)
+    assert saved == {"vertices": 3, "triangles": 2}
+    assert len(arrays[2]) == 3
+
+
+def test_weld_normal_tolerance():
+    vertices, normals, triangles, normal_indices = quad_arrays()
+    normals[1] = [0, 1e-3, 1]
+    assert len(GazeboExport.weld_arrays(quad_arrays(), 1e-6)[0][1]) == 1
+    arrays = (vertices, normals, triangles, normal_indices)
+    assert len(GazeboExport.weld_arrays(arrays, 1e-6)[0][1]) == 2
+    assert len(GazeboExport.weld_arrays(arrays, 1e-6, 1e-2)[0][1]) == 1
+
+
+def test_weld_settings():
+    assert GazeboExport.weld_settings({}) is None
+    assert GazeboExport.weld_settings({"weld_tolerance": 1e-6}) == (1e-6, 1e-4)
+    assert GazeboExport.weld_settings({"weld_tolerance": 1e-6,
+                                       "weld_normal_tolerance": 0.01}) == (1e-6, 0.01)
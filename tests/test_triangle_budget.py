@@ -0,0 +1,62 @@
+import types
+
+import GazeboExport
+
+
+class FakeShape(object):
+    '''A shape of about area / deflection triangles, counting its copies'''
+    copies = 0
+
+    def __init__(self, area):
+        self.area = area
+        self.BoundBox = types.SimpleNamespace(DiagonalLength=100.0)
+
+    def copy(self, *args):
+        FakeShape.copies += 1
+        return FakeShape(self.area)
+
+    def tessellate(self, deflection):
+        return [], [(0, 1, 2)] * int(self.area / deflection)
+
+
+def fit(budget, monkeypatch, passes=GazeboExport.BUDGET_PASSES):
+    warnings = []
+    monkeypatch.setattr(GazeboExport.FreeCAD, "Console",
+                        types.SimpleNamespace(PrintWarning=warnings.append),
+                        raising=False)
+    built = []
+
+    def shapes():
+        built.append(len(built))
+        return (FakeShape(area) for area in (1000, 2000, 4000))
+
+    configs = {"adaptive_quality": 0.01}
+    scale = GazeboExport.fit_triangle_budget(shapes, configs, budget, passes)
+    return scale, len(built), warnings
+
+
+def test_budget_within_reach(monkeypatch):
+    scale, passes, warnings = fit(3500, monkeypatch)
+    # 7000 triangles at scale 1
+    assert scale == 1.1 * 7000 / 3500 and passes == 2 and not warnings
+    configs = {"adaptive_quality": 0.01, "quality_scale": scale}
+    assert sum(GazeboExport.triangle_count(FakeShape(area), configs)
+               for area in (1000, 2000, 4000)) <= 3500
+
+
+def test_budget_fits_at_once(monkeypatch):
+    assert fit(7000, monkeypatch) == (1, 1, [])
+
+
+def test_budget_out_of_reach_warns(monkeypatch):
+    scale, passes, warnings = fit(3500, monkeypatch, passes=1)
+    assert scale == 1 and passes == 1
+    assert "7000 triangles" in warnings[0]
+
+
+def test_counting_copies_every_shape():
+    FakeShape.copies = 0
+    shape = FakeShape(1000)
+    GazeboExport.triangle_count(shape, {"adaptive_quality": 0.01})
+    GazeboExport.triangle_count(shape, {"adaptive_quality": 0.01, "quality_scale": 2})
+    assert FakeShape.copies == 2